@@ -0,0 +1,292 @@
+'''
+HydraPy benchmarks
+
+Runs HydraPy against an in-process fakeredis server (or a real Redis with --redis)
+and writes messages per second and p50/p99 latencies for each scenario as JSON.
+'''
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import hydrapy.hydra as hydra_module
+from hydrapy import HydraPy, UMF_Message
+
+
+def use_fake_redis():
+    '''route HydraPy's connection pools to one shared in-process fakeredis server'''
+    import aioredis.abc
+    import fakeredis
+    import fakeredis.aioredis
+
+    server = fakeredis.FakeServer()
+    # fakeredis 1.7 checks pool classes against aioredis.AbcPool, which aioredis only exports from aioredis.abc
+    hydra_module.aioredis.AbcPool = hydra_module.aioredis.abc.AbcPool
+
+    async def create_redis_pool(address, pool_cls=None, **kwargs):
+        if pool_cls:
+            # keep HydraPy's pool instrumentation on top of the fake connections
+            kwargs['pool_cls'] = type(pool_cls.__name__, (pool_cls, fakeredis.aioredis.FakeConnectionsPool), {})
+        return await fakeredis.aioredis.create_redis_pool(server=server, **kwargs)
+
+    hydra_module.aioredis.create_redis_pool = create_redis_pool
+
+
+def create_service(service_name, redis_url, extra_config=None, message_handler=None):
+    config = {
+        'hydra': {
+            'serviceName': service_name,
+            'serviceIP': '127.0.0.1',
+            'servicePort': 0,
+            'serviceType': 'benchmark',
+            'serviceDescription': 'HydraPy benchmark service',
+            'redis': redis_url
+        }
+    }
+    config['hydra'].update(extra_config or {})
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as config_file:
+        json.dump(config, config_file)
+    try:
+        return HydraPy(config_path=config_file.name, version='0.0.0',
+                       message_handler=message_handler, queue_handler=None)
+    finally:
+        os.unlink(config_file.name)
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        'operations': count,
+        'seconds': elapsed,
+        'perSecond': count / elapsed if elapsed else 0.0,
+        'p50': latencies[int(count * 0.5)] if count else 0.0,
+        'p99': latencies[min(count - 1, int(count * 0.99))] if count else 0.0,
+        'max': latencies[-1] if count else 0.0
+    }
+
+
+async def measure(operation, count):
+    '''run an operation count times, one after the other, timing each call'''
+    latencies = []
+    started = time.perf_counter()
+    for i in range(count):
+        op_started = time.perf_counter()
+        await operation(i)
+        latencies.append(time.perf_counter() - op_started)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+async def bench_publish(hydra, target, count):
+    '''messages go to another service, messages to the sender's own instance never reach Redis'''
+    instance_id = target.get_server_instance_id()
+    service_name = target.get_service_name()
+
+    async def direct(i):
+        await hydra.send_message(UMF_Message().create_message({
+            'to': f'{instance_id}@{service_name}:/',
+            'frm': f'{service_name}:/',
+            'bdy': {'n': i}
+        }))
+
+    async def routed(i):
+        await hydra.send_message(UMF_Message().create_message({
+            'to': f'{service_name}:/',
+            'frm': f'{service_name}:/',
+            'bdy': {'n': i}
+        }))
+
+    async def broadcast(i):
+        await hydra.send_broadcast_message(UMF_Message().create_message({
+            'to': f'{service_name}:/',
+            'frm': f'{service_name}:/',
+            'bdy': {'n': i}
+        }))
+
+    return {
+        'publish_direct': await measure(direct, count),
+        'publish_routed': await measure(routed, count),
+        'publish_broadcast': await measure(broadcast, count)
+    }
+
+
+async def register_nodes(redis, service_name, nodes):
+    '''write presence entries for fake instances, the way running services do'''
+    updated_on = UMF_Message.get_time_stamp()
+    tr = redis.multi_exec()
+    for n in range(nodes):
+        instance_id = f'{n:032x}'
+        tr.set(f'hydra:service:{service_name}:{instance_id}:presence', instance_id)
+        tr.hset('hydra:service:nodes', instance_id, json.dumps({
+            'serviceName': service_name,
+            'instanceID': instance_id,
+            'ip': '127.0.0.1',
+            'port': 0,
+            'updatedOn': updated_on
+        }))
+        tr.zadd(f'hydra:service:{service_name}:instances', time.time(), instance_id)
+    await tr.execute()
+
+
+async def bench_presence(redis_url, node_counts, count):
+    results = {}
+    for nodes in node_counts:
+        service_name = f'bench-nodes-{nodes}'
+        uncached = create_service(f'bench-presence-{nodes}', redis_url, {'presenceCache': {'enabled': False}})
+        await uncached.init()
+        await register_nodes(uncached.get_redis_client(), service_name, nodes)
+        indexed = create_service(f'bench-indexed-{nodes}', redis_url,
+                                 {'presenceCache': {'enabled': False}, 'presenceIndex': True})
+        await indexed.init()
+        cached = create_service(f'bench-cached-{nodes}', redis_url)
+        await cached.init()
+        # fewer iterations as lookups get slower, so large node counts finish in reasonable time
+        iterations = max(5, min(count, count * 10 // nodes))
+
+        def lookup(hydra):
+            async def operation(i):
+                await hydra.get_presence(service_name)
+            return operation
+
+        results[f'presence_scan_{nodes}'] = await measure(lookup(uncached), iterations)
+        results[f'presence_index_{nodes}'] = await measure(lookup(indexed), iterations)
+        results[f'presence_cached_{nodes}'] = await measure(lookup(cached), count)
+    return results
+
+
+async def bench_queue(redis_url, backend, count, batch_size):
+    hydra = create_service(f'bench-queue-{backend}', redis_url, {'queue': {'backend': backend}})
+    await hydra.init()
+    service_name = hydra.get_service_name()
+
+    async def enqueue(i):
+        await hydra.queue_message({
+            'to': f'{service_name}:/',
+            'frm': f'{service_name}:/',
+            'bdy': {'n': i}
+        })
+
+    results = {f'queue_{backend}_enqueue': await measure(enqueue, count)}
+    dequeued = []
+
+    async def dequeue(i):
+        dequeued.extend(await hydra.get_queue_messages(batch_size))
+
+    results[f'queue_{backend}_dequeue_batch'] = await measure(dequeue, count // batch_size)
+
+    async def ack(i):
+        await hydra.mark_queue_messages(dequeued[i * batch_size:(i + 1) * batch_size], True, 'done')
+
+    results[f'queue_{backend}_ack_batch'] = await measure(ack, count // batch_size)
+    results[f'queue_{backend}_enqueue']['batchSize'] = 1
+    results[f'queue_{backend}_dequeue_batch']['batchSize'] = batch_size
+    results[f'queue_{backend}_ack_batch']['batchSize'] = batch_size
+    return results
+
+
+async def bench_dispatch(redis_url, bursts, burst_size, local):
+    '''end to end latency from send to handler while bursts of messages arrive at once'''
+    latencies = []
+    done = asyncio.Event()
+    expected = bursts * burst_size
+
+    async def handler(message):
+        latencies.append(time.perf_counter() - message['bdy']['sent'])
+        await asyncio.sleep(0)
+        if len(latencies) == expected:
+            done.set()
+
+    hydra = create_service('bench-dispatch', redis_url, message_handler=handler)
+    await hydra.init()
+    instance_id = hydra.get_server_instance_id()
+    if local:
+        sender = hydra
+    else:
+        sender = create_service('bench-dispatch-sender', redis_url)
+        await sender.init()
+    started = time.perf_counter()
+    for _ in range(bursts):
+        await sender.send_messages([UMF_Message().create_message({
+            'to': f'{instance_id}@bench-dispatch:/',
+            'frm': 'bench-dispatch:/',
+            'bdy': {'sent': time.perf_counter()}
+        }) for _ in range(burst_size)])
+    await asyncio.wait_for(done.wait(), 60)
+    result = summarize(latencies, time.perf_counter() - started)
+    result['burstSize'] = burst_size
+    return {'dispatch_local_burst' if local else 'dispatch_burst': result}
+
+
+async def run(args):
+    redis_url = args.redis or 'redis://fakeredis'
+    if not args.redis:
+        use_fake_redis()
+    scenarios = {}
+
+    async def scenario(name, coroutine):
+        if args.only and not any(name.startswith(prefix) for prefix in args.only):
+            coroutine.close()
+            return
+        print(f'running {name}', flush=True)
+        try:
+            scenarios.update(await coroutine)
+        except Exception as e:
+            scenarios[name] = {'error': f'{type(e).__name__}: {e}'}
+
+    publisher = create_service('bench-publish', redis_url)
+    await publisher.init()
+    target = create_service('bench-target', redis_url)
+    await target.init()
+    # wait for the first heartbeat so routed messages can find an instance
+    await asyncio.sleep(1.5)
+    await scenario('publish', bench_publish(publisher, target, args.count))
+    await scenario('presence', bench_presence(redis_url, args.nodes, args.count))
+    for backend in args.queue_backends:
+        await scenario(f'queue_{backend}', bench_queue(redis_url, backend, args.count, args.batch_size))
+    await scenario('dispatch_burst', bench_dispatch(redis_url, args.bursts, args.burst_size, False))
+    await scenario('dispatch_local', bench_dispatch(redis_url, args.bursts, args.burst_size, True))
+
+    return {
+        'hydrapyVersion': open(os.path.join(os.path.dirname(hydra_module.__file__), 'VERSION')).read().rstrip(),
+        'python': f'{platform.python_implementation()} {platform.python_version()}',
+        'platform': f'{platform.system()} {platform.machine()}',
+        'redis': args.redis or 'fakeredis',
+        'createdOn': UMF_Message.get_time_stamp(),
+        'scenarios': scenarios
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HydraPy benchmarks')
+    parser.add_argument('--redis', help='benchmark against this Redis URL instead of an in-process fakeredis')
+    parser.add_argument('--output', default='benchmark-results.json', help='where to write the JSON results')
+    parser.add_argument('--count', type=int, default=2000, help='operations per scenario')
+    parser.add_argument('--nodes', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                        help='registered node counts for the presence lookup scenarios')
+    parser.add_argument('--queue-backends', nargs='+', default=['list', 'reliable'],
+                        help='queue backends to benchmark (stream needs Redis 6.2 or later)')
+    parser.add_argument('--batch-size', type=int, default=100, help='dequeue and ack batch size')
+    parser.add_argument('--bursts', type=int, default=20, help='number of message bursts to dispatch')
+    parser.add_argument('--burst-size', type=int, default=500, help='messages per burst')
+    parser.add_argument('--only', nargs='+', help='only run scenarios starting with these names')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    for name, result in results['scenarios'].items():
+        if 'error' in result:
+            print(f'{name:32} {result["error"]}')
+        else:
+            print(f'{name:32} {result["perSecond"]:12.1f}/s  p50 {result["p50"] * 1000:8.3f}ms  p99 {result["p99"] * 1000:8.3f}ms')
+    print(f'results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,9 @@
 from .hydra import HydraPy
 from .hydra import hydra_route
 from .hydra import UMF_Message
+from .hydra import LoadBalancingStrategy
+from .hydra import HydraLogHandler
+from .hydra import HydraSupervisor
 
 def version():
     return open('VERSION').read().rstrip()
@@ -17,8 +17,18 @@
 # SOFTWARE.
 
 import aioredis
+import aioredis.commands.streams
 import asyncio
+import base64
+import calendar
+import copy
+import functools
+import hashlib
+import heapq
 import json
+import logging
+import multiprocessing
+import multiprocessing.connection
 import os
 import time
 import platform
@@ -26,15 +36,83 @@ import psutil
 import random
 import re
 import shortuuid
+import signal
 import socket
 import uuid
+import zlib
 
-from datetime import datetime
+from collections import OrderedDict, deque, namedtuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+_message_ids = []
+# forked workers would otherwise hand out the same pre-generated ids as their parent
+os.register_at_fork(after_in_child=_message_ids.clear)
+_time_stamp_second = None
+_time_stamp_prefix = ''
+
+
+def _message_id():
+    '''uuid4 hex ids carved from one urandom call per batch of 256'''
+    if not _message_ids:
+        h = os.urandom(16 * 256).hex()
+        for i in range(0, len(h), 32):
+            # set the version 4 and RFC 4122 variant bits, as uuid.uuid4() does
+            _message_ids.append(f'{h[i:i + 12]}4{h[i + 13:i + 16]}{"89ab"[int(h[i + 16], 16) & 3]}{h[i + 17:i + 32]}')
+    return _message_ids.pop()
+
+
+def _time_stamp():
+    '''ISO 8601 timestamp, formatting the date and time only once per second'''
+    global _time_stamp_second, _time_stamp_prefix
+    now = time.time()
+    second = int(now)
+    if second != _time_stamp_second:
+        _time_stamp_prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(second))
+        _time_stamp_second = second
+    return f'{_time_stamp_prefix}.{int((now - second) * 1000000):06d}Z'
 
 
 class UMF_Message:
+    __slots__ = ('_message',)
     _UMF_VERSION = 'UMF/1.4.6'
-    _message = None
+
+    # short form field names and their long form equivalents, in output order
+    _FIELDS = (
+        ('to', 'to'),
+        ('frm', 'from'),
+        ('hdr', 'headers'),
+        ('mid', 'mid'),
+        ('rmid', 'rmid'),
+        ('sig', 'signature'),
+        ('tmo', 'timeout'),
+        ('ts', 'timestamp'),
+        ('typ', 'type'),
+        ('ver', 'version'),
+        ('via', 'via'),
+        ('fwd', 'forward'),
+        ('bdy', 'body'),
+        ('aut', 'authorization')
+    )
 
     def __init__(self):
         self._message = {}
@@ -47,11 +125,11 @@ class UMF_Message:
 
     def get_time_stamp():
         '''retrieve an ISO 8601 timestamp'''
-        return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        return _time_stamp()
 
     def create_message_id():
         '''Returns a UUID for use with messages'''
-        return uuid.uuid4().hex
+        return _message_id()
 
     def create_short_message_id():
         '''Returns a short form UUID for use with messages'''
@@ -65,115 +143,1257 @@ class UMF_Message:
         '''convert a long message to a short one'''
         msg = {}
         msg.update(message)
-        if 'to' in message:
-            msg['to'] = message['to']
-        if 'from' in message:
-            msg['frm'] = message['from']
-        if 'headers' in message:
-            msg['hdr'] = message['headers']
-        if 'mid' in message:
-            msg['mid'] = message['mid']
-        if 'rmid' in message:
-            msg['rmid'] = message['rmid']
-        if 'signature' in message:
-            msg['sig'] = message['signature']
-        if 'timeout' in message:
-            msg['tmo'] = message['timeout']
-        if 'timestamp' in message:
-            msg['ts'] = message['timestamp']
-        if 'type' in message:
-            msg['typ'] = message['type']
-        if 'version' in message:
-            msg['ver'] = message['version']
-        if 'via' in message:
-            msg['via'] = message['via']
-        if 'forward' in message:
-            msg['fwd'] = message['forward']
-        if 'body' in message:
-            msg['bdy'] = message['body']
-        if 'authorization' in message:
-            msg['aut'] = message['authorization']
+        for short, long in UMF_Message._FIELDS:
+            if long in message:
+                msg[short] = message[long]
         return msg
 
     def create_message(self, message):
-        message = self.to_short(message)
-        if 'to' in message:
-            self._message['to'] = message['to']
-        if 'frm' in message:
-            self._message['frm'] = message['frm']
-        if 'hdr' in message:
-            self._message['hdr'] = message['hdr']
-        if 'mid' in message:
-            self._message['mid'] = message['mid']
-        else:
-            self._message['mid'] = UMF_Message.create_message_id()
-        if 'rmid' in message:
-            self._message['rmid'] = message['rmid']
-        if 'sig' in message:
-            self._message['sig'] = message['sig']
-        if 'tmo' in message:
-            self._message['tmo'] = message['tmo']
-        if 'ts' in message:
-            self._message['ts'] = message['ts']
-        else:
-            self._message['ts'] = UMF_Message.get_time_stamp()
-        if 'typ' in message:
-            self._message['typ'] = message['typ']
-        if 'ver' in message:
-            self._message['ver'] = message['ver']
-        else:
-            self._message['ver'] = self._UMF_VERSION
-        if 'via' in message:
-            self._message['via'] = message['via']
-        if 'fwd' in message:
-            self._message['fwd'] = message['fwd']
-        if 'bdy' in message:
-            self._message['bdy'] = message['bdy']
-        if 'aut' in message:
-            self._message['aut'] = message['aut']
-        return self._message
+        '''build the short form message in one pass, long form field names take precedence'''
+        msg = self._message
+        for short, long in UMF_Message._FIELDS:
+            if long in message:
+                msg[short] = message[long]
+            elif short in message:
+                msg[short] = message[short]
+            elif short == 'mid':
+                msg['mid'] = _message_id()
+            elif short == 'ts':
+                msg['ts'] = _time_stamp()
+            elif short == 'ver':
+                msg['ver'] = self._UMF_VERSION
+        return msg
 
     def parse_route(to_value):
-        service_name = ''
-        http_method = ''
-        api_route = ''
-        error = ''
-        instance = ''
-        sub_id = ''
-        segments = to_value.split(':')
-        if len(segments) < 2:
-            error = 'route field has invalid number of routable segments'
+        '''parse a UMF route, results are cached as routes repeat constantly'''
+        return _parse_route(to_value)
+
+    def route_cache_stats():
+        info = _parse_route.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            'hits': info.hits,
+            'misses': info.misses,
+            'hitRate': info.hits / lookups if lookups else 0.0,
+            'size': info.currsize,
+            'maxSize': info.maxsize
+        }
+
+
+class Route(namedtuple('Route', ['instance', 'sub_id', 'service_name', 'http_method', 'api_route', 'error'])):
+    '''Immutable parsed route which also supports the route['field'] access of the old dict'''
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+
+# [instance[-sub_id]@]service_name:[[http_method]]api_route
+_ROUTE_PATTERN = re.compile(
+    r'(?:(?P<instance>[^@:-]*)(?:-(?P<sub_id>[^@:-]*))?[^@:]*@)?'
+    r'(?P<service_name>[^@:]*)[^:]*:'
+    r'(?:\[(?P<http_method>[^\]]+)\])?(?P<api_route>[^:]*)')
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_route(to_value):
+    m = _ROUTE_PATTERN.match(to_value)
+    if not m:
+        return Route('', '', '', '', '', 'route field has invalid number of routable segments')
+    return Route(m.group('instance') or '', m.group('sub_id') or '', m.group('service_name'),
+                 m.group('http_method') or '', m.group('api_route'), '')
+
+
+def _encode_default(obj):
+    '''decode lazily held bodies when a message is encoded using another codec'''
+    if type(obj) is RawBody:
+        return obj.decode()
+    raise TypeError(f'Object of type {type(obj).__name__} is not serializable')
+
+
+def _copy_message(value):
+    '''deep copy of JSON shaped data, much cheaper than copy.deepcopy or an encode/decode round trip'''
+    value_type = type(value)
+    if value_type is dict or value_type is LazyMessage:
+        return {key: _copy_message(item) for key, item in value.items()}
+    if value_type is list:
+        return [_copy_message(item) for item in value]
+    if value_type in (str, int, float, bool) or value is None:
+        return value
+    return copy.deepcopy(value)
+
+
+class JsonCodec:
+    name = 'json'
+    binary = False
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':'), default=_encode_default)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    '''drop-in JSON codec backed by orjson, emits the same compact JSON'''
+    name = 'orjson'
+
+    def dumps(self, obj):
+        return orjson.dumps(obj, default=_encode_default, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class RawBody:
+    '''A message bdy which hasn't been decoded yet'''
+    __slots__ = ('raw', 'codec')
+
+    def __init__(self, raw, codec):
+        self.raw = raw
+        self.codec = codec
+
+    def decode(self):
+        return self.codec.loads_body(self.raw)
+
+
+class LazyMessage(dict):
+    '''A received message which decodes its bdy the first time it's read'''
+    __slots__ = ()
+
+    def _materialize(self):
+        body = dict.get(self, 'bdy')
+        if type(body) is RawBody:
+            dict.__setitem__(self, 'bdy', body.decode())
+        return self
+
+    def is_body_decoded(self):
+        return type(dict.get(self, 'bdy')) is not RawBody
+
+    def __getitem__(self, key):
+        if key == 'bdy':
+            self._materialize()
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key == 'bdy':
+            self._materialize()
+        return dict.get(self, key, default)
+
+    def pop(self, key, *default):
+        if key == 'bdy':
+            self._materialize()
+        return dict.pop(self, key, *default)
+
+    def setdefault(self, key, default=None):
+        if key == 'bdy':
+            self._materialize()
+        return dict.setdefault(self, key, default)
+
+    def popitem(self):
+        return dict.popitem(self._materialize())
+
+    def items(self):
+        return dict.items(self._materialize())
+
+    def values(self):
+        return dict.values(self._materialize())
+
+    def __iter__(self):
+        # dict(message) and {**message} go through keys() and __getitem__ when __iter__ is overridden
+        return dict.__iter__(self)
+
+    def copy(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        return dict.__eq__(self._materialize(), other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return dict.__repr__(self._materialize())
+
+
+class MsgpackCodec:
+    '''msgpack with the bdy packed as a separate extension so receivers can defer decoding it'''
+    name = 'msgpack'
+    binary = True
+    _BODY_EXT_TYPE = 1
+
+    def dumps(self, obj):
+        body = dict.get(obj, 'bdy')
+        if body is not None:
+            obj = dict(zip(dict.keys(obj), dict.values(obj)))
+            if type(body) is RawBody and body.codec is self:
+                # forwarded without being read, pass the original bytes through
+                obj['bdy'] = msgpack.ExtType(self._BODY_EXT_TYPE, body.raw)
+            else:
+                obj['bdy'] = msgpack.ExtType(self._BODY_EXT_TYPE, msgpack.packb(body, use_bin_type=True, default=_encode_default))
+        return msgpack.packb(obj, use_bin_type=True, default=_encode_default)
+
+    def loads(self, data):
+        message = msgpack.unpackb(data, raw=False, strict_map_key=False, ext_hook=self._ext_hook)
+        return LazyMessage(message) if isinstance(message, dict) else message
+
+    def loads_body(self, data):
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+    def _ext_hook(self, code, data):
+        if code == self._BODY_EXT_TYPE:
+            return RawBody(data, self)
+        return msgpack.ExtType(code, data)
+
+    def detect(data):
+        '''msgpack encoded UMF messages always start with a map marker, queue entries arrive already decoded to str'''
+        return type(data) is bytes and len(data) > 0 and (0x80 <= data[0] <= 0x8f or data[0] in (0xde, 0xdf))
+
+
+class Compressor:
+    '''Compresses large message bodies, the algorithm travels with the message in its cmp field'''
+
+    def __init__(self, codec, algorithm='zlib', threshold=16384, level=None):
+        self._codec = codec
+        self._compressors = {'zlib': (functools.partial(zlib.compress, level=6 if level is None else level),
+                                      zlib.decompress)}
+        if zstandard:
+            self._compressors['zstd'] = (zstandard.ZstdCompressor(level=3 if level is None else level).compress,
+                                         zstandard.ZstdDecompressor().decompress)
+        if lz4:
+            self._compressors['lz4'] = (functools.partial(lz4.frame.compress, compression_level=level or 0),
+                                        lz4.frame.decompress)
+        if algorithm not in self._compressors:
+            raise ValueError(f'unsupported compression algorithm: {algorithm}')
+        self.algorithm = algorithm
+        self.algorithms = list(self._compressors)
+        self.threshold = threshold
+        self.compressed = 0
+        self.skipped = 0
+        self.unsupported = 0
+        self.decompressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_time = 0.0
+        self.decompress_time = 0.0
+
+    def select(self, instances):
+        '''the algorithm every instance can decompress, or None when one of them can't'''
+        for algorithm in (self.algorithm, 'zlib'):
+            if instances and all(algorithm in instance.get('compression', ()) for instance in instances):
+                return algorithm
+        self.unsupported = self.unsupported + 1
+        return None
+
+    def compress(self, umf_message, algorithm, binary):
+        '''a copy of umf_message with its bdy compressed, or None when that doesn't make it smaller'''
+        started = time.perf_counter()
+        body = self._codec.dumps(umf_message['bdy'])
+        if type(body) is str:
+            body = body.encode()
+        data = self._compressors[algorithm][0](body)
+        self.compress_time = self.compress_time + time.perf_counter() - started
+        if len(data) >= len(body):
+            self.skipped = self.skipped + 1
+            return None
+        self.compressed = self.compressed + 1
+        self.bytes_in = self.bytes_in + len(body)
+        self.bytes_out = self.bytes_out + len(data)
+        message = dict(zip(dict.keys(umf_message), dict.values(umf_message)))
+        message['cmp'] = algorithm
+        message['bdy'] = data if binary else base64.b64encode(data).decode()
+        return message
+
+    def loads_body(self, raw):
+        '''RawBody codec interface, raw is the algorithm and the compressed bdy'''
+        algorithm, data = raw
+        if type(data) is RawBody:
+            data = data.decode()
+        if type(data) is str:
+            data = base64.b64decode(data)
+        if algorithm not in self._compressors:
+            raise ValueError(f'unsupported compression algorithm: {algorithm}')
+        started = time.perf_counter()
+        body = self._codec.loads(self._compressors[algorithm][1](data))
+        self.decompress_time = self.decompress_time + time.perf_counter() - started
+        self.decompressed = self.decompressed + 1
+        return body
+
+    def stats(self):
+        return {
+            'algorithm': self.algorithm,
+            'threshold': self.threshold,
+            'compressed': self.compressed,
+            'skipped': self.skipped,
+            'unsupported': self.unsupported,
+            'decompressed': self.decompressed,
+            'bytesIn': self.bytes_in,
+            'bytesOut': self.bytes_out,
+            'bytesSaved': self.bytes_in - self.bytes_out,
+            'compressTime': self.compress_time,
+            'decompressTime': self.decompress_time
+        }
+
+
+class PresenceCache:
+    '''In-memory, per-service cache of get_presence results'''
+
+    def __init__(self, fetch, ttl, max_staleness, max_idle):
+        self._fetch = fetch
+        self._ttl = ttl
+        self._max_staleness = max_staleness
+        self._max_idle = max_idle
+        self._entries = {}
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    async def get(self, service_name):
+        '''return cached instances, fetching on a miss or past the staleness bound'''
+        now = time.monotonic()
+        entry = self._entries.get(service_name)
+        if entry and now - entry['fetchedOn'] < self._max_staleness:
+            self.hits = self.hits + 1
+            entry['accessedOn'] = now
+            if now - entry['fetchedOn'] >= self._ttl:
+                self._schedule_refresh(service_name)
+            return entry['instances']
+        self.misses = self.misses + 1
+        return await self._refresh(service_name)
+
+    def tick(self):
+        '''refresh entries older than the ttl and drop ones nobody reads anymore'''
+        now = time.monotonic()
+        for service_name, entry in list(self._entries.items()):
+            if now - entry['accessedOn'] > self._max_idle:
+                del self._entries[service_name]
+            elif now - entry['fetchedOn'] >= self._ttl:
+                self._schedule_refresh(service_name)
+
+    def invalidate(self, service_name=None):
+        if service_name is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(service_name, None)
+
+    def instance_added(self, service_name, instance_id):
+        entry = self._entries.get(service_name)
+        if entry and instance_id not in entry['ids']:
+            self._schedule_refresh(service_name)
+
+    def instance_removed(self, service_name, instance_id):
+        entry = self._entries.get(service_name)
+        if entry and instance_id in entry['ids']:
+            entry['instances'] = [i for i in entry['instances'] if i['instanceID'] != instance_id]
+            entry['ids'].discard(instance_id)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': self.hits / lookups if lookups else 0.0,
+            'refreshes': self.refreshes,
+            'errors': self.errors,
+            'services': len(self._entries)
+        }
+
+    def _refresh(self, service_name):
+        future = self._pending.get(service_name)
+        if future is None:
+            future = asyncio.ensure_future(self._load(service_name))
+            self._pending[service_name] = future
+        return future
+
+    def _schedule_refresh(self, service_name):
+        self._refresh(service_name).add_done_callback(self._refresh_done)
+
+    def _refresh_done(self, future):
+        if not future.cancelled() and future.exception():
+            self.errors = self.errors + 1
+
+    async def _load(self, service_name):
+        try:
+            instances = await self._fetch(service_name)
+            now = time.monotonic()
+            entry = self._entries.get(service_name)
+            self._entries[service_name] = {
+                'instances': instances,
+                'ids': {i['instanceID'] for i in instances},
+                'fetchedOn': now,
+                'accessedOn': entry['accessedOn'] if entry else now
+            }
+            self.refreshes = self.refreshes + 1
+            return instances
+        finally:
+            del self._pending[service_name]
+
+
+class LoadBalancingStrategy:
+    '''Base class for selecting an instance from a service's presence list'''
+    name = None
+
+    def select(self, service_name, instances):
+        raise NotImplementedError
+
+
+class RandomStrategy(LoadBalancingStrategy):
+    name = 'random'
+
+    def select(self, service_name, instances):
+        return random.choice(instances) if instances else None
+
+
+class RoundRobinStrategy(LoadBalancingStrategy):
+    name = 'round-robin'
+
+    def __init__(self):
+        self._counters = {}
+
+    def select(self, service_name, instances):
+        if not instances:
+            return None
+        n = self._counters.get(service_name, 0)
+        self._counters[service_name] = n + 1
+        return instances[n % len(instances)]
+
+
+class PowerOfTwoChoicesStrategy(LoadBalancingStrategy):
+    '''pick two instances at random and use the one with fewer in-flight handlers and less CPU load'''
+    name = 'p2c'
+
+    def select(self, service_name, instances):
+        n = len(instances)
+        if n < 2:
+            return instances[0] if n else None
+        a, b = random.sample(range(n), 2)
+        return min(instances[a], instances[b], key=self._load)
+
+    def _load(self, instance):
+        load = instance.get('load') or {}
+        return (load.get('inFlight', 0), load.get('cpu', 0), load.get('lag', 0))
+
+
+class FreshnessStrategy(LoadBalancingStrategy):
+    '''avoid instances whose heartbeat lags behind the rest of the service'''
+    name = 'freshest'
+
+    def __init__(self, max_lag=1):
+        self._max_lag = max_lag
+        self._fresh = {}
+        self._counters = {}
+
+    def select(self, service_name, instances):
+        if not instances:
+            return None
+        cached = self._fresh.get(service_name)
+        if cached is None or cached[0] is not instances:
+            newest = max(i['updatedOnTS'] for i in instances)
+            cached = (instances, [i for i in instances if newest - i['updatedOnTS'] <= self._max_lag])
+            self._fresh[service_name] = cached
+        fresh = cached[1]
+        n = self._counters.get(service_name, 0)
+        self._counters[service_name] = n + 1
+        return fresh[n % len(fresh)]
+
+
+_load_balancing_strategies = {
+    RandomStrategy.name: RandomStrategy,
+    RoundRobinStrategy.name: RoundRobinStrategy,
+    PowerOfTwoChoicesStrategy.name: PowerOfTwoChoicesStrategy,
+    FreshnessStrategy.name: FreshnessStrategy
+}
+
+
+class CircuitBreaker:
+    '''Per instance circuit breaker, opened by failed requests and half-opened after a cooldown'''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold, cooldown):
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        # instanceID: [state, consecutive failures, time of the last state change]
+        self._instances = {}
+        self.opened = 0
+        self.rejected = 0
+
+    def available(self, instance_id):
+        entry = self._instances.get(instance_id)
+        if entry is None or entry[0] == self.CLOSED:
+            return True
+        # open, or half open with a trial request which hasn't reported back yet
+        if time.monotonic() - entry[2] >= self._cooldown:
+            return True
+        self.rejected = self.rejected + 1
+        return False
+
+    def selected(self, instance_id):
+        '''an instance past its cooldown was picked, let this request through as the trial'''
+        entry = self._instances.get(instance_id)
+        if entry and entry[0] != self.CLOSED:
+            entry[0] = self.HALF_OPEN
+            entry[2] = time.monotonic()
+
+    def record_success(self, instance_id):
+        self._instances.pop(instance_id, None)
+
+    def tripped(self):
+        '''whether any circuit is open or half open, until then every instance is available'''
+        return any(entry[0] != self.CLOSED for entry in self._instances.values())
+
+    def record_failure(self, instance_id):
+        now = time.monotonic()
+        entry = self._instances.get(instance_id)
+        if entry is None:
+            entry = self._instances[instance_id] = [self.CLOSED, 0, now]
+        entry[1] = entry[1] + 1
+        if entry[0] == self.HALF_OPEN or entry[1] >= self._failure_threshold:
+            if entry[0] != self.OPEN:
+                self.opened = self.opened + 1
+            entry[0] = self.OPEN
+            entry[2] = now
+
+    def prune(self):
+        '''forget instances which have gone quiet, most of them have left the cluster'''
+        oldest = time.monotonic() - self._cooldown * 10
+        for instance_id in [key for key, entry in self._instances.items() if entry[2] < oldest]:
+            del self._instances[instance_id]
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            'opened': self.opened,
+            'rejected': self.rejected,
+            'instances': {
+                instance_id: {
+                    'state': state,
+                    'failures': failures,
+                    'secondsInState': now - changed
+                } for instance_id, (state, failures, changed) in self._instances.items()
+            }
+        }
+
+
+class DedupCache:
+    '''Bounded LRU of recently seen message ids, entries also expire after ttl seconds'''
+
+    def __init__(self, capacity, ttl):
+        self._capacity = capacity
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self.duplicates = 0
+
+    def seen(self, mid):
+        '''record mid, returns True when it was already recorded'''
+        if self.contains(mid):
+            self.duplicates = self.duplicates + 1
+            return True
+        self.add(mid)
+        return False
+
+    def contains(self, mid):
+        recorded = self._entries.get(mid)
+        if recorded is None:
+            return False
+        if time.monotonic() - recorded > self._ttl:
+            del self._entries[mid]
+            return False
+        self._entries.move_to_end(mid)
+        return True
+
+    def add(self, mid):
+        self._entries[mid] = time.monotonic()
+        self._entries.move_to_end(mid)
+        if len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'duplicates': self.duplicates
+        }
+
+
+class PendingRequests:
+    '''Futures for outstanding requests keyed by mid and expired from a deadline heap'''
+
+    def __init__(self):
+        self._futures = {}
+        self._deadlines = []
+        self._timer = None
+        self._timer_when = None
+        self.sent = 0
+        self.completed = 0
+        self.timeouts = 0
+
+    def add(self, mid, timeout):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._futures[mid] = future
+        self.sent = self.sent + 1
+        deadline = loop.time() + timeout
+        heapq.heappush(self._deadlines, (deadline, mid))
+        if self._timer_when is None or deadline < self._timer_when:
+            self._schedule(loop, deadline)
+        return future
+
+    def discard(self, mid):
+        self._futures.pop(mid, None)
+
+    def __len__(self):
+        return len(self._futures)
+
+    def resolve(self, message):
+        '''complete the request a reply message refers to, returns False for non replies'''
+        future = self._futures.pop(message.get('rmid'), None)
+        if future is None:
+            return False
+        if not future.done():
+            self.completed = self.completed + 1
+            future.set_result(message)
+        return True
+
+    def stats(self):
+        return {
+            'pending': len(self._futures),
+            'sent': self.sent,
+            'completed': self.completed,
+            'timeouts': self.timeouts
+        }
+
+    def _schedule(self, loop, when):
+        if self._timer:
+            self._timer.cancel()
+        self._timer = loop.call_at(when, self._expire)
+        self._timer_when = when
+
+    def _expire(self):
+        loop = asyncio.get_running_loop()
+        self._timer = None
+        self._timer_when = None
+        now = loop.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, mid = heapq.heappop(self._deadlines)
+            future = self._futures.pop(mid, None)
+            if future and not future.done():
+                self.timeouts = self.timeouts + 1
+                future.set_exception(asyncio.TimeoutError(f'no reply received for message {mid}'))
+        if self._deadlines:
+            self._schedule(loop, self._deadlines[0][0])
+
+
+class MessageDispatcher:
+    '''Bounded queue and worker pool for inbound message handlers'''
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop-oldest'
+    SPILL = 'spill'
+
+    def __init__(self, handler, max_in_flight, queue_size, overflow, spill=None, pause_reading=None):
+        if overflow not in (self.BLOCK, self.DROP_OLDEST, self.SPILL):
+            raise ValueError(f'unknown dispatcher overflow policy: {overflow}')
+        self._handler = handler
+        self._max_in_flight = max_in_flight
+        self._overflow = overflow
+        self._spill = spill
+        self._pause_reading = pause_reading
+        self._reading_paused = False
+        self._queue = asyncio.Queue(queue_size)
+        # messages read while the queue is full, readers never wait so replies to requests still get through
+        self._backlog = deque()
+        self._workers = []
+        self._handling = {}
+        self.in_flight = 0
+        self.processed = 0
+        self.errors = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.read_pauses = 0
+        self.handler_time = 0.0
+        self.handler_time_max = 0.0
+
+    def start(self):
+        for _ in range(self._max_in_flight):
+            self._workers.append(asyncio.ensure_future(self._worker()))
+
+    def would_block(self):
+        return self._overflow == self.BLOCK and (self._queue.full() or bool(self._backlog))
+
+    async def submit(self, message):
+        if self._overflow == self.BLOCK and self.would_block():
+            self._backlog.append(message)
+            if self._pause_reading and not self._reading_paused:
+                # stop reading from Redis rather than let messages pile up in the subscriber's buffers
+                self._reading_paused = True
+                self.read_pauses = self.read_pauses + 1
+                self._pause_reading(True)
+        elif not self._queue.full():
+            self._queue.put_nowait(message)
+        elif self._overflow == self.DROP_OLDEST:
+            self._queue.get_nowait()
+            self._queue.task_done()
+            self.dropped = self.dropped + 1
+            self._queue.put_nowait(message)
         else:
-            sub_segments = segments[0].split('@')
-            if len(sub_segments) == 1:
-                service_name = segments[0]
+            self.spilled = self.spilled + 1
+            await self._spill(message)
+
+    async def drain(self, timeout):
+        '''wait for queued and in flight messages, then stop the workers; returns unhandled messages'''
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        # handlers still running at the deadline are cancelled, their messages are returned too
+        remaining = list(self._handling.values())
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+        while not self._queue.empty():
+            remaining.append(self._queue.get_nowait())
+            self._queue.task_done()
+        remaining.extend(self._backlog)
+        self._backlog.clear()
+        return remaining
+
+    def stats(self):
+        return {
+            'queueDepth': self._queue.qsize(),
+            'backlog': len(self._backlog),
+            'inFlight': self.in_flight,
+            'processed': self.processed,
+            'errors': self.errors,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'readPauses': self.read_pauses,
+            'readingPaused': self._reading_paused,
+            'handlerTimeAvg': self.handler_time / self.processed if self.processed else 0.0,
+            'handlerTimeMax': self.handler_time_max
+        }
+
+    async def _worker(self):
+        worker = asyncio.current_task()
+        while True:
+            message = await self._queue.get()
+            while self._backlog and not self._queue.full():
+                self._queue.put_nowait(self._backlog.popleft())
+            if self._reading_paused and self._queue.qsize() + len(self._backlog) <= self._queue.maxsize // 2:
+                self._reading_paused = False
+                self._pause_reading(False)
+            self.in_flight = self.in_flight + 1
+            self._handling[worker] = message
+            started = time.perf_counter()
+            try:
+                await self._handler(message)
+            except Exception as e:
+                self.errors = self.errors + 1
+                asyncio.get_running_loop().call_exception_handler({
+                    'message': 'message handler raised an exception',
+                    'exception': e
+                })
+            finally:
+                elapsed = time.perf_counter() - started
+                del self._handling[worker]
+                self.in_flight = self.in_flight - 1
+                self.processed = self.processed + 1
+                self.handler_time = self.handler_time + elapsed
+                if elapsed > self.handler_time_max:
+                    self.handler_time_max = elapsed
+                self._queue.task_done()
+
+
+class OutboundPublisher:
+    '''Coalesces PUBLISH commands into pipelines, preserving submission order'''
+
+    def __init__(self, redis, window, max_batch):
+        self._redis = redis
+        self._window = window
+        self._max_batch = max_batch
+        self._buffer = []
+        self._ready = asyncio.Event()
+        self._timer = None
+        self._task = None
+        self._closed = False
+        self.published = 0
+        self.batches = 0
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def publish(self, channel, data):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._buffer.append((channel, data, future))
+        if len(self._buffer) >= self._max_batch:
+            self._ready.set()
+        elif self._timer is None:
+            if self._window:
+                self._timer = loop.call_later(self._window, self._ready.set)
             else:
-                sub_id = sub_segments[0].split('-')
-                l = len(sub_id)
-                if l < 0:
-                    sub_id = sub_id[0]
-                elif l > 1:
-                    instance = sub_id[0]
-                    sub_id = sub_id[1]
-                else:
-                    instance = sub_id[0]
-                    sub_id = ''
-                service_name = sub_segments[1]
-        x = re.search(r'\[(.*?)\]', segments[1])
-        if x and x.group(1):
-            http_method = x.group(1)
-            segments[1] = segments[1].replace(f'[{http_method}]', '')
-        api_route = segments[1]
+                self._timer = loop.call_soon(self._ready.set)
+        return future
+
+    def stats(self):
+        return {
+            'published': self.published,
+            'batches': self.batches,
+            'averageBatchSize': self.published / self.batches if self.batches else 0.0,
+            'buffered': len(self._buffer)
+        }
+
+    async def close(self):
+        '''publish whatever is still buffered, then stop the flusher'''
+        self._closed = True
+        self._ready.set()
+        await self._task
+
+    async def _run(self):
+        while not self._closed:
+            await self._ready.wait()
+            self._ready.clear()
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            while self._buffer:
+                batch = self._buffer[:self._max_batch]
+                del self._buffer[:self._max_batch]
+                await self._flush(batch)
+
+    async def _flush(self, batch):
+        pipe = self._redis.pipeline()
+        for channel, data, _ in batch:
+            pipe.publish(channel, data)
+        try:
+            results = await pipe.execute(return_exceptions=True)
+        except Exception as e:
+            results = [e] * len(batch)
+        self.batches = self.batches + 1
+        self.published = self.published + len(batch)
+        for (_, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class MeasuredConnectionsPool(aioredis.ConnectionsPool):
+    '''ConnectionsPool which records how long callers wait to acquire a connection'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.observe = None
+        self.acquired = 0
+        self.waited = 0
+        self.wait_time = 0.0
+        self.wait_time_max = 0.0
+
+    async def acquire(self, command=None, args=()):
+        # plain commands share free connections, only transactions and pipelines acquire one
+        if not self.freesize and self.size >= self.maxsize:
+            self.waited = self.waited + 1
+        started = time.perf_counter()
+        conn = await super().acquire(command, args)
+        elapsed = time.perf_counter() - started
+        self.acquired = self.acquired + 1
+        self.wait_time = self.wait_time + elapsed
+        if elapsed > self.wait_time_max:
+            self.wait_time_max = elapsed
+        if self.observe:
+            self.observe(elapsed)
+        return conn
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'freeSize': self.freesize,
+            'minSize': self.minsize,
+            'maxSize': self.maxsize,
+            'acquired': self.acquired,
+            'waited': self.waited,
+            'waitTimeAvg': self.wait_time / self.acquired if self.acquired else 0.0,
+            'waitTimeMax': self.wait_time_max
+        }
+
+
+class LogShipper:
+    '''Buffers log entries in a bounded ring and ships them to Redis in periodic batches'''
+
+    SEVERITIES = {'trace': 0, 'debug': 1, 'info': 2, 'warn': 3, 'error': 4, 'fatal': 5}
+
+    def __init__(self, ship, level, capacity, interval, max_batch):
+        if level not in self.SEVERITIES:
+            raise ValueError(f'unknown log level: {level}')
+        self._ship = ship
+        self._threshold = self.SEVERITIES[level]
+        self._buffer = deque(maxlen=capacity)
+        self._interval = interval
+        self._max_batch = max_batch
+        self._task = None
+        self._closed = False
+        self._wakeup = asyncio.Event()
+        self.shipped = 0
+        self.batches = 0
+        self.filtered = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def enabled_for(self, severity):
+        # severities this shipper doesn't know about are always shipped
+        return self.SEVERITIES.get(severity, self._threshold) >= self._threshold
+
+    def append(self, record):
+        if len(self._buffer) == self._buffer.maxlen:
+            # the ring overwrites its oldest entry
+            self.dropped = self.dropped + 1
+        self._buffer.append(record)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stats(self):
         return {
-            'instance': instance,
-            'sub_id': sub_id,
-            'service_name': service_name,
-            'http_method': http_method,
-            'api_route': api_route,
-            'error': error
+            'buffered': len(self._buffer),
+            'shipped': self.shipped,
+            'batches': self.batches,
+            'filtered': self.filtered,
+            'dropped': self.dropped,
+            'failed': self.failed
         }
 
+    async def close(self):
+        '''ship whatever is still buffered, then stop'''
+        self._closed = True
+        self._wakeup.set()
+        if self._task:
+            await self._task
+
+    async def _run(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self):
+        while self._buffer:
+            batch = [self._buffer.popleft() for _ in range(min(self._max_batch, len(self._buffer)))]
+            try:
+                await self._ship(batch)
+            except Exception as e:
+                self.failed = self.failed + len(batch)
+                asyncio.get_running_loop().call_exception_handler({
+                    'message': 'failed to ship log entries',
+                    'exception': e
+                })
+                return
+            self.batches = self.batches + 1
+            self.shipped = self.shipped + len(batch)
+
+
+class HydraLogHandler(logging.Handler):
+    '''logging.Handler which sends records through a HydraPy instance's log shipper'''
+
+    _SEVERITIES = (
+        (logging.CRITICAL, 'fatal'),
+        (logging.ERROR, 'error'),
+        (logging.WARNING, 'warn'),
+        (logging.INFO, 'info'),
+        (logging.DEBUG, 'debug')
+    )
+
+    def __init__(self, hydra, level=logging.NOTSET):
+        super().__init__(level)
+        self._hydra = hydra
+
+    def emit(self, record):
+        severity = next((name for levelno, name in self._SEVERITIES if record.levelno >= levelno), 'trace')
+        if not self._hydra.is_log_enabled(severity):
+            return
+        try:
+            self._hydra.log_nowait(severity, {
+                'logger': record.name,
+                'module': record.module,
+                'line': record.lineno
+            }, self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+class LatencyHistogram:
+    '''HDR style log-linear histogram of durations with about 3% relative precision'''
+
+    _SUB_BUCKETS = 32
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        us = int(seconds * 1000000)
+        if us < self._SUB_BUCKETS * 2:
+            index = us
+        else:
+            shift = us.bit_length() - 6
+            index = shift * self._SUB_BUCKETS + (us >> shift)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count = self.count + 1
+        self.total = self.total + seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def _bucket_value(self, index):
+        if index < self._SUB_BUCKETS * 2:
+            return index / 1000000
+        shift = index // self._SUB_BUCKETS - 1
+        return (index - shift * self._SUB_BUCKETS << shift) / 1000000
+
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.counts):
+            seen = seen + self.counts[index]
+            if seen >= rank:
+                return min(self._bucket_value(index), self.max)
+        return self.max
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'p999': self.percentile(0.999)
+        }
+
+
+class Metrics:
+    '''latency histograms and labelled message counters for the hot paths'''
+
+    _QUANTILES = (0.5, 0.9, 0.99, 0.999)
 
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, name, seconds):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = self._histograms[name] = LatencyHistogram()
+        histogram.record(seconds)
+
+    def increment(self, name, label, value):
+        '''label values must come from a small set, every one of them is kept for good'''
+        counter = self._counters.get(name)
+        if counter is None:
+            counter = self._counters[name] = (label, {})
+        counter[1][value] = counter[1].get(value, 0) + 1
+
+    def stats(self):
+        return {
+            'histograms': {name: histogram.stats() for name, histogram in self._histograms.items()},
+            'counters': {name: dict(counter) for name, (_, counter) in self._counters.items()}
+        }
+
+    def prometheus(self, labels):
+        '''render in the Prometheus text exposition format, histograms as summaries'''
+        common = ','.join(f'{key}="{self._escape(value)}"' for key, value in labels.items())
+        lines = []
+        for name, histogram in sorted(self._histograms.items()):
+            metric = f'hydrapy_{name}_seconds'
+            lines.append(f'# TYPE {metric} summary')
+            for q in self._QUANTILES:
+                lines.append(f'{metric}{{{common},quantile="{q}"}} {histogram.percentile(q)}')
+            lines.append(f'{metric}_sum{{{common}}} {histogram.total}')
+            lines.append(f'{metric}_count{{{common}}} {histogram.count}')
+        for name, (label, counter) in sorted(self._counters.items()):
+            metric = f'hydrapy_{name}_total'
+            lines.append(f'# TYPE {metric} counter')
+            for value, n in sorted(counter.items()):
+                lines.append(f'{metric}{{{common},{label}="{self._escape(value)}"}} {n}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# The presence index is scored by Redis server time, hosts with a skewed clock would otherwise
+# prune every other instance or never find them
+# KEYS: index  ARGV: instanceID, seconds before an instance is left out
+_PRESENCE_INDEX_UPDATE_SCRIPT = '''
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+redis.call('ZADD', KEYS[1], now, ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - tonumber(ARGV[2]))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+'''
+
+# KEYS: index, nodes  ARGV: seconds before an instance is left out
+_PRESENCE_INDEX_FETCH_SCRIPT = '''
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], now - tonumber(ARGV[1]), '+inf')
+if #ids == 0 then
+    return {}
+end
+return redis.call('HMGET', KEYS[2], unpack(ids))
+'''
+
+# Lua helper shared by the reliable queue scripts: legacy list entries are full JSON
+# messages which are keyed by their mid (or a hash of the payload when it has none)
+_QUEUE_MESSAGE_ID_LUA = '''
+local function message_id(raw)
+    local ok, msg = pcall(cjson.decode, raw)
+    if ok and type(msg) == 'table' and type(msg['mid']) == 'string' then
+        return msg['mid']
+    end
+    return redis.sha1hex(raw)
+end
+'''
+
+# Delayed messages wait in a sorted set per lane scored by due time. They are always full payloads,
+# so consumers of either backend promote what list and reliable producers delayed
+# KEYS: mqinprogress, then mqrecieved and delayed for each lane, highest priority first
+# ARGV: now, max messages, max delayed messages to promote per lane
+_QUEUE_LIST_DEQUEUE_SCRIPT = '''
+for i = 2, #KEYS, 2 do
+    local due = redis.call('ZRANGEBYSCORE', KEYS[i + 1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+    if #due > 0 then
+        redis.call('ZREM', KEYS[i + 1], unpack(due))
+        redis.call('LPUSH', KEYS[i], unpack(due))
+    end
+end
+local payloads = {}
+for i = 2, #KEYS, 2 do
+    while #payloads < tonumber(ARGV[2]) do
+        local raw = redis.call('RPOPLPUSH', KEYS[i], KEYS[1])
+        if not raw then
+            break
+        end
+        payloads[#payloads + 1] = raw
+    end
+end
+return payloads
+'''
+
+# KEYS: inprogress, messages, then pending, mqrecieved and delayed for each lane, highest priority first
+# ARGV: now, max messages, max delayed messages to promote per lane, visibility deadline
+_QUEUE_DEQUEUE_SCRIPT = _QUEUE_MESSAGE_ID_LUA + '''
+for i = 3, #KEYS, 3 do
+    local due = redis.call('ZRANGEBYSCORE', KEYS[i + 2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+    if #due > 0 then
+        redis.call('ZREM', KEYS[i + 2], unpack(due))
+        for _, raw in ipairs(due) do
+            local id = message_id(raw)
+            redis.call('HSET', KEYS[2], id, raw)
+            redis.call('LPUSH', KEYS[i], id)
+        end
+    end
+end
+local payloads = {}
+for i = 3, #KEYS, 3 do
+    while #payloads < tonumber(ARGV[2]) do
+        local id = redis.call('RPOP', KEYS[i])
+        if not id then
+            -- then messages list backend producers pushed onto the same lane
+            local raw = redis.call('RPOP', KEYS[i + 1])
+            if not raw then
+                break
+            end
+            id = message_id(raw)
+            redis.call('HSET', KEYS[2], id, raw)
+        end
+        local payload = redis.call('HGET', KEYS[2], id)
+        if payload then
+            redis.call('ZADD', KEYS[1], ARGV[4], id)
+            payloads[#payloads + 1] = payload
+        end
+    end
+end
+return payloads
+'''
+
+# KEYS: inprogress, messages, then pending for each lane  ARGV: now, max entries to reclaim, default lane,
+# then the lane name of each pending key
+_QUEUE_RECLAIM_SCRIPT = '''
+local lanes = {}
+for i = 3, #KEYS do
+    lanes[ARGV[i + 1]] = KEYS[i]
+end
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, id in ipairs(ids) do
+    redis.call('ZREM', KEYS[1], id)
+    local lane = lanes[ARGV[3]]
+    local ok, msg = pcall(cjson.decode, redis.call('HGET', KEYS[2], id) or '')
+    if ok and type(msg) == 'table' and type(msg['hdr']) == 'table' and lanes[msg['hdr']['priority']] then
+        lane = lanes[msg['hdr']['priority']]
+    end
+    redis.call('RPUSH', lane, id)
+end
+return #ids
+'''
+
+# Appends due delayed messages, and messages list backend producers and other Hydra implementations
+# pushed to mqrecieved, to the stream
+# KEYS: stream, then mqrecieved and delayed for each lane, highest priority first
+# ARGV: now, max messages to move per key, max stream length
+_QUEUE_STREAM_PROMOTE_SCRIPT = '''
+local promoted = 0
+for i = 2, #KEYS, 2 do
+    local due = redis.call('ZRANGEBYSCORE', KEYS[i + 1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+    for _, raw in ipairs(due) do
+        redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[3], '*', 'message', raw)
+    end
+    if #due > 0 then
+        redis.call('ZREM', KEYS[i + 1], unpack(due))
+    end
+    promoted = promoted + #due
+    for n = 1, tonumber(ARGV[2]) do
+        local raw = redis.call('RPOP', KEYS[i])
+        if not raw then
+            break
+        end
+        redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[3], '*', 'message', raw)
+        promoted = promoted + 1
+    end
+end
+return promoted
+'''
+
+# KEYS: source list, pending, messages  ARGV: max entries to migrate
+_QUEUE_MIGRATE_SCRIPT = _QUEUE_MESSAGE_ID_LUA + '''
+local moved = 0
+while moved < tonumber(ARGV[1]) do
+    local raw = redis.call('RPOP', KEYS[1])
+    if not raw then
+        break
+    end
+    local id = message_id(raw)
+    redis.call('HSET', KEYS[3], id, raw)
+    redis.call('LPUSH', KEYS[2], id)
+    moved = moved + 1
+end
+return moved
+'''
+
+
+# routes declared with hydra_route() before an instance registers them, kept for compatibility
 _routes = []
 
 
@@ -187,11 +1407,21 @@ class HydraPy:
     _PRESENCE_UPDATE_INTERVAL = _ONE_SECOND
     _HEALTH_UPDATE_INTERVAL = _ONE_SECOND * 5
     _KEY_EXPIRATION_TTL = _ONE_SECOND * 3
+    _REQUEST_TIMEOUT = _ONE_SECOND * 30
+    _QUEUE_VISIBILITY_TIMEOUT = _ONE_SECOND * 60
+    _QUEUE_BATCH_SIZE = 1000
+    _QUEUE_STREAM_MAX_LENGTH = 100000
+    # priority lanes, highest first. the default lane uses the keys shared with other Hydra implementations
+    _QUEUE_PRIORITIES = ('high', 'normal', 'low')
+    _QUEUE_DEFAULT_PRIORITY = 'normal'
+    _QUEUE_PROMOTE_BATCH_SIZE = 100
 
     _redis_pre_key = 'hydra:service'
     _mc_message_key = 'hydra:service:mc'
 
     _redis = None
+    _subscriber_redis = None
+    _heartbeat_redis = None
     _config = None
     _service_version = ''
     _service_name = ''
@@ -201,6 +1431,57 @@ class HydraPy:
     _instance_id = None
     _hydra_event_count = 0
     _hydra_routes = []
+    _route_registry = None
+    _local_delivery = True
+    _circuit_breaker = None
+    _dedup_received = None
+    _dedup_completed = None
+    _dedup_window = 0
+    _max_heartbeat_age = None
+    _fresh_instances = None
+    _stale_instances = 0
+    _local_deliveries = 0
+    _remote_deliveries = 0
+    _presence_cache = None
+    _presence_keyspace_events = False
+    _presence_index = False
+    _load_balancer = None
+    _process = None
+    _process_started = 0
+    _host_name = ''
+    _platform_info = None
+    _presence_entry = None
+    _health = None
+    _load = None
+    _loop_lag = 0
+    _pending_requests = None
+    _dispatcher = None
+    _reading_paused = False
+    _codec = None
+    _binary_codec = None
+    _compressor = None
+    _compress = False
+    _publisher = None
+    _queue_backend = 'list'
+    _queue_visibility_timeout = _QUEUE_VISIBILITY_TIMEOUT
+    _script_hashes = None
+    _queue_wakeup = None
+    _queue_block_timeout = None
+    _queue_max_length = _QUEUE_STREAM_MAX_LENGTH
+    _queue_promote_batch_size = _QUEUE_PROMOTE_BATCH_SIZE
+    _queue_lanes_unsupported = 0
+    _stream_entries = None
+    _stream_claimed = None
+    _stream_claim_cursor = '0-0'
+    _metrics = None
+    _log_shipper = None
+    _queue_unacked = None
+    _tasks = None
+    _readers = None
+    _channels = None
+    _queue_task = None
+    _stopping = False
+    _lag_probe_interval = 0.1
 
     _message_handler = None
     _queue_handler = None
@@ -246,6 +1527,99 @@ class HydraPy:
         self._service_description = entry['serviceDescription']
         self._service_type = entry['serviceType']
 
+        cache_config = entry.get('presenceCache', {})
+        if cache_config.get('enabled', True):
+            self._presence_cache = PresenceCache(
+                self._fetch_presence,
+                cache_config.get('ttl', self._PRESENCE_UPDATE_INTERVAL),
+                cache_config.get('maxStaleness', self._KEY_EXPIRATION_TTL),
+                cache_config.get('maxIdle', self._ONE_SECOND * 60))
+            self._presence_keyspace_events = cache_config.get('keyspaceEvents', False)
+
+        if 'presenceIndex' in entry:
+            self._presence_index = entry['presenceIndex']
+
+        self.set_load_balancing_strategy(entry.get('loadBalancing', RandomStrategy.name))
+        self._pending_requests = PendingRequests()
+        self._route_registry = []
+        self._local_delivery = entry.get('localDelivery', True)
+
+        dedup_config = entry.get('dedup', {})
+        if dedup_config.get('enabled', False):
+            capacity = dedup_config.get('capacity', 10000)
+            ttl = dedup_config.get('ttl', self._ONE_SECOND * 300)
+            self._dedup_received = DedupCache(capacity, ttl)
+            self._dedup_completed = DedupCache(capacity, ttl)
+            self._dedup_window = dedup_config.get('redisWindow', 0)
+
+        breaker_config = entry.get('circuitBreaker', {})
+        if breaker_config.get('enabled', True):
+            self._circuit_breaker = CircuitBreaker(
+                breaker_config.get('failureThreshold', 5),
+                breaker_config.get('cooldown', self._ONE_SECOND * 10))
+        self._max_heartbeat_age = breaker_config.get('maxHeartbeatAge', self._ONE_SECOND * 5)
+        self._fresh_instances = {}
+
+        codec = entry.get('codec', 'orjson' if orjson else 'json')
+        if codec not in ('json', 'orjson', 'msgpack'):
+            raise ValueError(f'unknown codec: {codec}')
+        if codec == 'orjson' and not orjson:
+            raise ValueError('the orjson codec requires the orjson package')
+        if codec == 'msgpack':
+            if not msgpack:
+                raise ValueError('the msgpack codec requires the msgpack package')
+            self._binary_codec = MsgpackCodec()
+        self._codec = OrjsonCodec() if orjson and codec != 'json' else JsonCodec()
+
+        compression_config = entry.get('compression', {})
+        self._compressor = Compressor(self._codec,
+                                      compression_config.get('algorithm', 'zlib'),
+                                      compression_config.get('threshold', 16384),
+                                      compression_config.get('level'))
+        self._compress = compression_config.get('enabled', False)
+
+        queue_config = entry.get('queue', {})
+        self._queue_backend = queue_config.get('backend', 'list')
+        if self._queue_backend not in ('list', 'reliable', 'stream'):
+            raise ValueError(f'unknown queue backend: {self._queue_backend}')
+        self._queue_visibility_timeout = queue_config.get('visibilityTimeout', self._QUEUE_VISIBILITY_TIMEOUT)
+        self._queue_block_timeout = queue_config.get('blockTimeout')
+        self._queue_max_length = queue_config.get('maxLength', self._QUEUE_STREAM_MAX_LENGTH)
+        self._queue_promote_batch_size = queue_config.get('promoteBatchSize', self._QUEUE_PROMOTE_BATCH_SIZE)
+        self._script_hashes = {}
+        self._stream_entries = {}
+        self._stream_claimed = []
+        self._queue_unacked = {}
+
+        log_config = entry.get('logging', {})
+        self._log_shipper = LogShipper(
+            self._ship_logs,
+            log_config.get('level', 'trace'),
+            log_config.get('bufferSize', 10000),
+            log_config.get('flushInterval', self._ONE_SECOND),
+            log_config.get('maxBatch', 500))
+
+        metrics_config = entry.get('metrics', {})
+        if metrics_config.get('enabled', False):
+            # timed wrappers shadow the methods on this instance, so nothing changes when disabled
+            self._metrics = Metrics()
+            self._lag_probe_interval = metrics_config.get('lagProbeInterval', self._lag_probe_interval)
+            self._instrument('publish', self._publish)
+            self._instrument('presence_lookup', self._get_instances)
+            self._instrument('queue_enqueue', self.queue_message)
+            self._instrument('queue_dequeue', self.get_queue_messages)
+            self._instrument('queue_mark', self.mark_queue_messages)
+            self._instrument('handler', self._dispatch_message)
+
+        dispatcher_config = entry.get('dispatcher', {})
+        self._dispatcher = MessageDispatcher(
+            self._dispatch_message,
+            dispatcher_config.get('maxInFlight', 100),
+            dispatcher_config.get('queueSize', 10000),
+            dispatcher_config.get('overflow', MessageDispatcher.BLOCK),
+            self._spill_message,
+            self._pause_reading)
+
     def get_service_name(self):
         return self._service_name
 
@@ -271,43 +1645,244 @@ class HydraPy:
         }
 
     def get_health(self):
-        pid = os.getpid()
-        p = psutil.Process(pid)
+        '''the latest health sample, refreshed every _HEALTH_UPDATE_INTERVAL seconds'''
+        if not self._health:
+            self._health = self._build_health(self._collect_process_metrics())
+        return dict(self._health)
+
+    def _collect_process_metrics(self):
+        '''blocking psutil calls, run in an executor by the health check'''
+        p = self._process
+        with p.oneshot():
+            memory = p.memory_info()
+            return {
+                'cpu': p.cpu_percent(),
+                'rss': memory.rss,
+                'vms': memory.vms,
+                'threads': p.num_threads(),
+                'fds': p.num_fds() if hasattr(p, 'num_fds') else p.num_handles()
+            }
+
+    def _build_health(self, metrics):
+        dispatcher = self._dispatcher.stats()
         return {
             'serviceName': self._service_name,
             'instanceID': self._instance_id,
-            'hostName': socket.gethostname(),
+            'hostName': self._host_name,
             'sampledOn': UMF_Message.get_time_stamp(),
-            'processID': pid,
-            'architecture': f'{platform.machine()}',
-            'platform': f'{platform.system()}',
-            'nodeVersion': f'{platform.python_implementation()} {platform.python_version()}',
+            'processID': self._process.pid,
+            'architecture': self._platform_info['architecture'],
+            'platform': self._platform_info['platform'],
+            'nodeVersion': self._platform_info['nodeVersion'],
             'memory': {
-                'rss': p.memory_info()[0],
-                'heapTotal': p.memory_info()[1],
+                'rss': metrics['rss'],
+                'heapTotal': metrics['vms'],
                 'heapUsed': '',
                 'external': ''
             },
-            'uptimeSeconds': time.time() - psutil.boot_time()
+            'uptimeSeconds': time.time() - self._process_started,
+            'cpuPercent': metrics['cpu'],
+            'threads': metrics['threads'],
+            'openFileDescriptors': metrics['fds'],
+            'eventLoopLagSeconds': round(self._loop_lag, 6),
+            'inFlightHandlers': dispatcher['inFlight'],
+            'dispatchQueueDepth': dispatcher['queueDepth']
         }
 
+    def _instrument(self, name, method):
+        '''replace a coroutine method on this instance with one which records its latency'''
+        metrics = self._metrics
+
+        @functools.wraps(method)
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                metrics.observe(name, time.perf_counter() - started)
+
+        setattr(self, method.__name__, timed)
+
+    def get_metrics(self):
+        '''latency histograms and message counters, None unless metrics are enabled'''
+        if self._metrics:
+            return self._metrics.stats()
+        return None
+
+    def get_prometheus_metrics(self):
+        '''metrics in the Prometheus text exposition format, for a scrape endpoint'''
+        if not self._metrics:
+            return ''
+        return self._metrics.prometheus({
+            'service': self._service_name,
+            'instance': self._instance_id
+        })
+
+    def set_load_balancing_strategy(self, strategy):
+        '''use a built-in strategy by name or any LoadBalancingStrategy instance'''
+        if isinstance(strategy, str):
+            if strategy not in _load_balancing_strategies:
+                raise ValueError(f'unknown load balancing strategy: {strategy}')
+            strategy = _load_balancing_strategies[strategy]()
+        self._load_balancer = strategy
+
+    def get_load_balancing_strategy(self):
+        return self._load_balancer
+
     def get_redis_client(self):
         return self._redis
 
+    def get_connection_stats(self):
+        '''sizes and acquire wait times of the command and heartbeat pools'''
+        stats = {
+            'commands': self._redis.connection.stats(),
+            'subscriber': {
+                'dedicated': self._subscriber_redis is not self._redis,
+                'channels': len(self._subscriber_redis.connection.pubsub_channels),
+                'patterns': len(self._subscriber_redis.connection.pubsub_patterns)
+            }
+        }
+        if self._heartbeat_redis is not self._redis:
+            stats['heartbeat'] = self._heartbeat_redis.connection.stats()
+        return stats
+
     def _safe_json_stringify(self, umf_message):
-        return json.dumps(umf_message, separators=(',', ':'))
+        return self._codec.dumps(umf_message)
+
+    def _decode_message(self, data):
+        '''decode an inbound message, accepting both JSON and binary encoded peers'''
+        if self._binary_codec and MsgpackCodec.detect(data):
+            message = self._binary_codec.loads(data)
+        else:
+            message = self._codec.loads(data)
+        if not isinstance(message, dict):
+            raise ValueError(f'not a UMF message: {type(message).__name__}')
+        if 'cmp' in message:
+            # the bdy is only decompressed once it's read
+            message = message if type(message) is LazyMessage else LazyMessage(message)
+            raw = (dict.pop(message, 'cmp'), dict.get(message, 'bdy'))
+            dict.__setitem__(message, 'bdy', RawBody(raw, self._compressor))
+        return message
+
+    def _encode_message(self, umf_message, instance=None):
+        '''use the binary codec only for instances which advertise support for it'''
+        if self._binary_codec and instance and self._binary_codec.name in instance.get('codecs', ()):
+            return self._binary_codec.dumps(umf_message)
+        return self._codec.dumps(umf_message)
+
+    async def _publish(self, channel, data):
+        if self._metrics:
+            # by service, instance channels would add a label value for every instance ever sent to
+            self._metrics.increment('messages_out', 'target', channel[len(self._mc_message_key) + 1:].split(':')[0])
+        if self._publisher:
+            return await self._publisher.publish(channel, data)
+        return await self._redis.publish(channel, data)
 
     async def send_message(self, umf_message):
+        target = await self._resolve_target(umf_message)
+        if target:
+            await self._send_to(target[0], target[1])
+
+    async def send_messages(self, umf_messages):
+        '''send several messages, published together in as few pipelines as possible'''
+        targets = [await self._resolve_target(umf_message) for umf_message in umf_messages]
+        await asyncio.gather(*[self._send_to(target[0], target[1]) for target in targets if target])
+
+    async def _send_to(self, channel, data):
+        if channel is None:
+            if await self._receive_message(data, wait=False):
+                self._local_deliveries = self._local_deliveries + 1
+                return
+            # the dispatcher is full and the sender may be one of its handlers, so don't wait on it
+            channel = f'{self._mc_message_key}:{self._service_name}:{self._instance_id}'
+            data = self._encode_message(data)
+        self._remote_deliveries = self._remote_deliveries + 1
+        await self._publish(channel, data)
+
+    def get_delivery_stats(self):
+        '''how many sent messages were delivered in process rather than through Redis'''
+        return {
+            'local': self._local_deliveries,
+            'remote': self._remote_deliveries
+        }
+
+    async def _resolve_target(self, umf_message, trial=False):
+        '''returns the channel, encoded payload and instance for a message, or None without an instance.
+        messages for this instance get no channel and a private copy of the message instead.
+        only requests report back, so only they may be the trial which half-opens a circuit'''
         parsed_route = UMF_Message.parse_route(umf_message['to'])
-        if parsed_route['instance'] != '':
+        selected = None
+        if parsed_route.instance != '':
             # Use the instance explicitly declared
-            instance = parsed_route['instance']
+            instance = parsed_route.instance
         else:
             # Use an instance from a list of those available in hydra (more expensive)
-            instances_list = await self.get_presence(parsed_route['service_name'])
-            instance = instances_list[0]['instanceID'] if len(instances_list) else None
+            service_name = parsed_route.service_name
+            instances = self._healthy_instances(service_name, await self._get_instances(service_name))
+            selected = self._load_balancer.select(service_name, instances)
+            instance = selected['instanceID'] if selected else None
+            if instance and trial and self._circuit_breaker:
+                self._circuit_breaker.selected(instance)
+        if instance == self._instance_id and self._local_delivery:
+            return (None, _copy_message(umf_message), instance)
         if instance:
-            await self._redis.publish(f"{self._mc_message_key}:{parsed_route['service_name']}:{instance}", self._safe_json_stringify(umf_message))
+            data = self._encode_message(umf_message, selected)
+            if self._compress and len(data) > self._compressor.threshold:
+                peer = selected or await self._find_instance(parsed_route.service_name, instance)
+                data = self._compress_message(umf_message, [peer] if peer else [], data, peer)
+            return (f"{self._mc_message_key}:{parsed_route.service_name}:{instance}", data, instance)
+        return None
+
+    async def _find_instance(self, service_name, instance_id):
+        for instance in await self._get_instances(service_name):
+            if instance['instanceID'] == instance_id:
+                return instance
+        return None
+
+    def _compress_message(self, umf_message, instances, data, instance=None):
+        '''re-encode a large message with a compressed bdy when all receiving instances support it'''
+        algorithm = self._compressor.select(instances)
+        if not algorithm:
+            return data
+        binary = bool(self._binary_codec and instance and self._binary_codec.name in instance.get('codecs', ()))
+        message = self._compressor.compress(umf_message, algorithm, binary)
+        return self._encode_message(message, instance) if message else data
+
+    async def _compress_for_service(self, umf_message, service_name, data):
+        '''compress messages read by any instance of a service, broadcasts and queued messages'''
+        if self._compress and len(data) > self._compressor.threshold:
+            return self._compress_message(umf_message, await self._get_instances(service_name), data)
+        return data
+
+    def get_compression_stats(self):
+        '''bytes saved and time spent compressing and decompressing message bodies'''
+        return self._compressor.stats()
+
+    def _healthy_instances(self, service_name, instances):
+        '''leave out instances with a stale heartbeat or an open circuit.
+        the fresh list is kept per presence list, so strategies caching by list identity stay O(1)'''
+        cached = self._fresh_instances.get(service_name)
+        if cached is None or cached[0] is not instances:
+            cached = (instances, self._fresh(instances))
+            self._fresh_instances[service_name] = cached
+        breaker = self._circuit_breaker
+        if not breaker or not breaker.tripped():
+            return cached[1]
+        return [instance for instance in cached[1] if breaker.available(instance['instanceID'])]
+
+    def _fresh(self, instances):
+        '''heartbeats are compared with the freshest one rather than the local clock, which may be skewed'''
+        newest = max((instance.get('updatedOnTS', 0) for instance in instances), default=0)
+        oldest = newest - self._max_heartbeat_age
+        fresh = [instance for instance in instances if instance.get('updatedOnTS', newest) >= oldest]
+        self._stale_instances = self._stale_instances + len(instances) - len(fresh)
+        return fresh or instances
+
+    def get_circuit_breaker_stats(self):
+        '''breaker state by instanceID, for debugging instance selection'''
+        stats = self._circuit_breaker.stats() if self._circuit_breaker else {}
+        stats['staleSkipped'] = self._stale_instances
+        return stats
 
     async def send_message_reply(self, src_message, reply_message):
         msg = None
@@ -327,13 +1902,86 @@ class HydraPy:
         msg.update(reply_message)
         await self.send_message(msg)
 
+    async def request(self, umf_message, timeout=None):
+        '''send a message and wait for the reply which carries its mid as rmid'''
+        msg = (UMF_Message()).create_message(umf_message)
+        if timeout is None:
+            timeout = msg.get('tmo', self._REQUEST_TIMEOUT)
+        msg['tmo'] = timeout
+        frm = msg.get('frm', f'{self._service_name}:/')
+        if '@' not in frm.split(':')[0]:
+            # replies must come back to this instance rather than any instance of the service
+            frm = f'{self._instance_id}@{frm}'
+        msg['frm'] = frm
+        target = await self._resolve_target(msg, trial=True)
+        if not target:
+            raise LookupError(f'no available instance for {msg["to"]}')
+        channel, data, instance = target
+        future = self._pending_requests.add(msg['mid'], timeout)
+        if self._reading_paused:
+            self._update_reading()
+        try:
+            await self._send_to(channel, data)
+            breaker = self._circuit_breaker if instance != self._instance_id else None
+            try:
+                reply = await future
+            except asyncio.TimeoutError:
+                if breaker:
+                    breaker.record_failure(instance)
+                raise
+            if breaker:
+                if self._is_error_reply(reply):
+                    breaker.record_failure(instance)
+                else:
+                    breaker.record_success(instance)
+            return reply
+        finally:
+            self._pending_requests.discard(msg['mid'])
+            if self._reading_paused:
+                self._update_reading()
+
+    def _is_error_reply(self, reply):
+        if reply.get('typ') == 'error':
+            return True
+        body = reply.get('bdy')
+        return isinstance(body, dict) and 'error' in body
+
+    def get_request_stats(self):
+        return self._pending_requests.stats()
+
+    def get_publisher_stats(self):
+        if self._publisher:
+            return self._publisher.stats()
+        return None
+
     async def send_broadcast_message(self, umf_message):
         parsed_route = UMF_Message.parse_route(umf_message['to'])
-        key = f"{self._mc_message_key}:{parsed_route['service_name']}"
-        await self._redis.publish(key, self._safe_json_stringify(umf_message))
+        key = f"{self._mc_message_key}:{parsed_route.service_name}"
+        data = await self._compress_for_service(umf_message, parsed_route.service_name,
+                                                self._safe_json_stringify(umf_message))
+        await self._publish(key, data)
 
     async def get_presence(self, service_name):
-        instance_list = []
+        results = await self._get_instances(service_name)
+        return random.sample(results, len(results))
+
+    async def _get_instances(self, service_name):
+        if self._presence_cache:
+            return await self._presence_cache.get(service_name)
+        return await self._fetch_presence(service_name)
+
+    def get_presence_cache_stats(self):
+        if self._presence_cache:
+            return self._presence_cache.stats()
+        return None
+
+    def invalidate_presence(self, service_name=None):
+        if self._presence_cache:
+            self._presence_cache.invalidate(service_name)
+
+    async def _fetch_presence(self, service_name):
+        if self._presence_index:
+            return await self._fetch_indexed_presence(service_name)
         ids = []
         cur = b'0'
         while cur:
@@ -347,34 +1995,84 @@ class HydraPy:
                     instance_id = entry.split(':')[3]
                     trans.append(tr.hget(f'{self._redis_pre_key}:nodes', instance_id))
         await tr.execute()
-        results = []
         raw_results = await asyncio.gather(*trans)
+        return self._parse_node_entries(raw_results)
+
+    async def _fetch_indexed_presence(self, service_name):
+        '''discover instances using the per-service index instead of a keyspace scan'''
+        raw_results = await self._run_script(_PRESENCE_INDEX_FETCH_SCRIPT,
+                                             [f'{self._redis_pre_key}:{service_name}:instances',
+                                              f'{self._redis_pre_key}:nodes'],
+                                             [self._KEY_EXPIRATION_TTL])
+        return self._parse_node_entries(raw_results)
+
+    def _parse_node_entries(self, raw_results):
+        results = []
         for item in raw_results:
-            obj = json.loads(item)
+            if not item:
+                continue
+            obj = self._codec.loads(item)
             timestamp = obj['updatedOn'].replace('z', '+0000')
-            obj['updatedOnTS'] = int(time.mktime(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f%z')))
+            obj['updatedOnTS'] = calendar.timegm(time.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f%z'))
             results.append(obj)
-        return random.sample(results, len(results))
-
-    async def _flush_routes(self):
-        await self._redis.delete(f'{self._redis_pre_key}:{self._service_name}:service:routes')
+        return results
+
+    async def _watch_presence(self):
+        '''track membership changes through Redis keyspace notifications'''
+        ch = await self._subscriber_redis.psubscribe(f'__keyspace@*__:{self._redis_pre_key}:*:presence')
+        channel = ch[0]
+        while (await channel.wait_message()):
+            key, event = await channel.get(encoding='utf-8')
+            segments = key.decode('utf-8').split(':', 1)[1].split(':')
+            if len(segments) != 5:
+                continue
+            if event == 'set':
+                self._presence_cache.instance_added(segments[2], segments[3])
+            elif event in ('expired', 'del'):
+                self._presence_cache.instance_removed(segments[2], segments[3])
+
+    def add_route(self, route, methods):
+        '''declare an HTTP route served by this instance, published by register_routes'''
+        self._route_registry.append((route, methods))
 
     async def register_routes(self):
-        await self._flush_routes()
-        key = f'{self._redis_pre_key}:{self._service_name}:service:routes'
-        self._hydra_routes = [
+        '''update the service's route set with only the differences, returns whether it changed'''
+        # claim routes declared with the module level hydra_route()
+        self._route_registry.extend(_routes)
+        _routes.clear()
+        routes = [
             f'[get]/{self._service_name}',
             f'[get]/{self._service_name}/',
             f'[get]/{self._service_name}/:rest'
         ]
-        for route in _routes:
-            for method in route[1]:
-                self._hydra_routes.append(f'[{method.lower()}]{route[0]}')
+        for route, methods in self._route_registry:
+            for method in methods:
+                routes.append(f'[{method.lower()}]{route}')
+        self._hydra_routes = list(dict.fromkeys(routes))
+
+        key = f'{self._redis_pre_key}:{self._service_name}:service:routes'
+        routes_hash = hashlib.sha1('\n'.join(sorted(self._hydra_routes)).encode('utf-8')).hexdigest()
+        stored_hash, exists = await asyncio.gather(self._redis.get(f'{key}:hash'), self._redis.exists(key))
+        if stored_hash == routes_hash and exists:
+            # another instance of this version already registered the same routes
+            return False
+        current = set(await self._redis.smembers(key))
+        added = [route for route in self._hydra_routes if route not in current]
+        removed = list(current.difference(self._hydra_routes))
         tr = self._redis.multi_exec()
-        for route in self._hydra_routes:
-            tr.sadd(key, route)
+        if added:
+            tr.sadd(key, *added)
+        if removed:
+            tr.srem(key, *removed)
+        tr.set(f'{key}:hash', routes_hash)
         await tr.execute()
+        if not added and not removed:
+            return False
+        await self._notify_router()
+        return True
 
+    async def _notify_router(self):
+        '''ask hydra-router to reload this service's routes and instances'''
         msg = (UMF_Message()).create_message({
             'to': 'hydra-router:/refresh',
             'frm': f'{self._service_name}:/',
@@ -388,6 +2086,45 @@ class HydraPy:
     async def register_message_handler(self, message_handler):
         self._message_handler = message_handler
 
+    def get_dispatcher_stats(self):
+        return self._dispatcher.stats()
+
+    async def _dispatch_message(self, message):
+        if self._message_handler:
+            await self._message_handler(message)
+
+    async def _receive_message(self, message, wait=True):
+        '''returns False, leaving the message untouched, when it would have to wait for the dispatcher'''
+        if not wait and self._message_handler and self._dispatcher.would_block():
+            return False
+        if self._dedup_received and 'mid' in message and self._dedup_received.seen(message['mid']):
+            return True
+        if 'rmid' in message and self._pending_requests.resolve(message):
+            return True
+        if self._message_handler:
+            await self._dispatcher.submit(message)
+        return True
+
+    def _pause_reading(self, paused):
+        '''the dispatcher asks to pause or resume reading the pub/sub socket'''
+        self._reading_paused = paused
+        self._update_reading()
+
+    def _update_reading(self):
+        '''replies arrive on the same socket, so it keeps being read while any request waits for one.
+        a no-op for connections without a socket transport'''
+        connection = getattr(self._subscriber_redis.connection, '_pubsub_conn', None)
+        transport = getattr(getattr(connection, '_writer', None), 'transport', None)
+        if hasattr(transport, 'pause_reading'):
+            if self._reading_paused and not self._pending_requests and not self._stopping:
+                transport.pause_reading()
+            else:
+                transport.resume_reading()
+
+    async def _spill_message(self, message):
+        '''overflow target for the dispatcher: park the message on this service's queue'''
+        await self.queue_message(message)
+
     async def _register_service(self):
         service_entry = {
             'serviceName': self._service_name,
@@ -401,15 +2138,24 @@ class HydraPy:
         await asyncio.gather(f1)
 
         async def _message_reader(channel):
+            metrics = self._metrics
+            # the service's channel or this instance's own, both are labelled service and instance already
+            kind = 'instance' if channel.name.decode('utf-8').endswith(f':{self._instance_id}') else 'service'
             while (await channel.wait_message()):
-                if self._message_handler:
-                    msg = await channel.get_json()
-                    asyncio.ensure_future(self._message_handler(msg))
-
-        ch1 = await self._redis.subscribe(f'{self._mc_message_key}:{self._service_name}')
-        ch2 = await self._redis.subscribe(f'{self._mc_message_key}:{self._service_name}:{self._instance_id}')
-        asyncio.ensure_future(_message_reader(ch1[0]))
-        asyncio.ensure_future(_message_reader(ch2[0]))
+                if metrics:
+                    metrics.increment('messages_in', 'channel', kind)
+                try:
+                    msg = self._decode_message(await channel.get())
+                except ValueError:
+                    # skip malformed messages rather than stop reading the channel
+                    continue
+                await self._receive_message(msg)
+
+        self._dispatcher.start()
+        ch1 = await self._subscriber_redis.subscribe(f'{self._mc_message_key}:{self._service_name}')
+        ch2 = await self._subscriber_redis.subscribe(f'{self._mc_message_key}:{self._service_name}:{self._instance_id}')
+        self._channels = [ch1[0], ch2[0]]
+        self._readers = [asyncio.ensure_future(_message_reader(channel)) for channel in self._channels]
 
         return {
             'serviceName': self._service_name,
@@ -418,82 +2164,442 @@ class HydraPy:
         }
 
     async def _presence_event(self):
-        entry = {
-            'serviceName': self._service_name,
-            'serviceDescription': self._service_description,
-            'version': self._service_version,
-            'instanceID': self._instance_id,
-            'processID': os.getpid(),
-            'ip': self._service_ip,
-            'port': self._service_port,
-            'hostName': socket.gethostname()
-        }
+        entry = dict(self._presence_entry)
+        if self._load:
+            entry['load'] = self._load
+        if self._binary_codec:
+            entry['codecs'] = [self._binary_codec.name]
+        entry['compression'] = self._compressor.algorithms
+        entry['queueLanes'] = True
+        entry['queueBackend'] = self._queue_backend
         entry['updatedOn'] = UMF_Message.get_time_stamp()
-        tr = self._redis.multi_exec()
+        tr = self._heartbeat_redis.multi_exec()
         f1 = tr.setex(f'{self._redis_pre_key}:{self._service_name}:{self._instance_id}:presence',
                       self._KEY_EXPIRATION_TTL,
                       self._instance_id)
         f2 = tr.hset(f'{self._redis_pre_key}:nodes',
                      self._instance_id, self._safe_json_stringify(entry))
+        if self._presence_index:
+            # sent in full, NOSCRIPT would fail the whole transaction
+            tr.eval(_PRESENCE_INDEX_UPDATE_SCRIPT, [f'{self._redis_pre_key}:{self._service_name}:instances'],
+                    [self._instance_id, self._KEY_EXPIRATION_TTL])
         await tr.execute()
         await asyncio.gather(f1, f2)
 
     async def log(self, severity, entry, text=None):
-        new_entry = {
-            'serviceName': self._service_name,
-            'version': self._service_version,
-            'instanceID': self._instance_id,
-            'severity': severity,
-            'bdy': {}
-        }
-        if text:
-            new_entry['message'] = text
-        if entry:
-            new_entry['bdy'] = entry
-        await self.send_broadcast_message((UMF_Message()).create_message({
-            'to': 'hydra-logging-svcs:/',
-            'frm': f'{self._service_name}:/',
-            'bdy': new_entry
-        }))
+        self.log_nowait(severity, entry, text)
+
+    def log_nowait(self, severity, entry, text=None):
+        '''queue a log entry for the next batch, without waiting on Redis'''
+        shipper = self._log_shipper
+        if not shipper.enabled_for(severity):
+            shipper.filtered = shipper.filtered + 1
+            return
+        shipper.append((_time_stamp(), severity, entry, text))
+
+    def is_log_enabled(self, severity):
+        return self._log_shipper.enabled_for(severity)
+
+    def get_log_stats(self):
+        return self._log_shipper.stats()
+
+    async def flush_logs(self):
+        await self._log_shipper.flush()
+
+    async def _ship_logs(self, records):
+        '''publish a batch of log entries to hydra-logging-svcs in one pipeline'''
+        channel = f'{self._mc_message_key}:hydra-logging-svcs'
+        pipe = self._redis.pipeline()
+        for timestamp, severity, entry, text in records:
+            new_entry = {
+                'serviceName': self._service_name,
+                'version': self._service_version,
+                'instanceID': self._instance_id,
+                'severity': severity,
+                'bdy': entry or {}
+            }
+            if text:
+                new_entry['message'] = text
+            pipe.publish(channel, self._safe_json_stringify((UMF_Message()).create_message({
+                'to': 'hydra-logging-svcs:/',
+                'frm': f'{self._service_name}:/',
+                'timestamp': timestamp,
+                'bdy': new_entry
+            })))
+        await pipe.execute()
 
     async def register_queue_handler(self, queue_handler):
         self._queue_handler = queue_handler
 
+    async def _run_script(self, script, keys, args):
+        '''run a Lua script by its SHA1, loading it into Redis the first time'''
+        sha = self._script_hashes.get(script)
+        if sha:
+            try:
+                return await self._redis.evalsha(sha, keys=keys, args=args)
+            except aioredis.ReplyError as e:
+                if 'NOSCRIPT' not in str(e):
+                    raise
+        self._script_hashes[script] = await self._redis.script_load(script)
+        return await self._redis.evalsha(self._script_hashes[script], keys=keys, args=args)
+
+    def _queue_keys(self, service_name):
+        return {
+            'pending': f'{self._redis_pre_key}:{service_name}:mq:pending',
+            'inprogress': f'{self._redis_pre_key}:{service_name}:mq:inprogress',
+            'messages': f'{self._redis_pre_key}:{service_name}:mq:messages',
+            'stream': f'{self._redis_pre_key}:{service_name}:mq:stream'
+        }
+
+    def _queue_lanes(self, service_name, backend=None):
+        '''the ready and delayed keys of each priority lane, highest priority first'''
+        backend = backend or self._queue_backend
+        if backend == 'reliable':
+            ready = f'{self._redis_pre_key}:{service_name}:mq:pending'
+        elif backend == 'stream':
+            ready = f'{self._redis_pre_key}:{service_name}:mq:stream'
+        else:
+            ready = f'{self._redis_pre_key}:{service_name}:mqrecieved'
+        lanes = []
+        for priority in self._QUEUE_PRIORITIES:
+            delayed = f'{self._redis_pre_key}:{service_name}:mq:delayed:{priority}'
+            if priority == self._QUEUE_DEFAULT_PRIORITY or backend == 'stream':
+                lanes.append((ready, delayed))
+            else:
+                lanes.append((f'{ready}:{priority}', delayed))
+        return lanes
+
+    def _queue_priority(self, message):
+        '''index of the lane named by the message's priority header, unknown priorities use the default lane'''
+        headers = message.get('hdr')
+        priority = headers.get('priority') if isinstance(headers, dict) else None
+        if priority not in self._QUEUE_PRIORITIES:
+            priority = self._QUEUE_DEFAULT_PRIORITY
+        return self._QUEUE_PRIORITIES.index(priority)
+
+    def _queue_due_time(self, message):
+        '''when a message with a delay or deliverAt header is due, None to deliver it now'''
+        headers = message.get('hdr')
+        if not isinstance(headers, dict):
+            return None
+        if 'deliverAt' in headers:
+            due = float(headers['deliverAt'])
+        elif 'delay' in headers:
+            due = time.time() + float(headers['delay'])
+        else:
+            return None
+        return due if due > time.time() else None
+
+    async def _queue_target(self, service_name):
+        '''the queue backend a service's instances consume with, and whether they all read priority lanes.
+        other Hydra implementations and older HydraPy only read mqrecieved and never promote delays, while
+        a service with no instance running keeps its lanes and delays for whichever consumer starts next.
+        without a single known backend messages go to mqrecieved, which consumers of every backend read'''
+        instances = await self._get_instances(service_name)
+        if service_name == self._service_name:
+            # this instance may not have announced itself yet
+            instances = [instance for instance in instances if instance['instanceID'] != self._instance_id]
+            instances.append({'queueBackend': self._queue_backend, 'queueLanes': True})
+        backends = {instance.get('queueBackend', 'list') for instance in instances}
+        backend = backends.pop() if len(backends) == 1 else 'list'
+        return backend, all(instance.get('queueLanes') for instance in instances)
+
+    async def _create_queue_group(self):
+        '''all instances of a service share one consumer group on the service stream'''
+        try:
+            await self._redis.xgroup_create(self._queue_keys(self._service_name)['stream'],
+                                            self._service_name, latest_id='0', mkstream=True)
+        except aioredis.ReplyError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
     async def queue_message(self, message):
         ''' self._service_name isn't used here because any service can queue '''
         ''' a message for another service '''
         msg = (UMF_Message()).create_message(message)
         if UMF_Message.validate(msg):
             parsed_route = UMF_Message.parse_route(msg['to'])
-            if not parsed_route['error']:
-                service_name = parsed_route['service_name']
-                await self._redis.lpush(f'{self._redis_pre_key}:{service_name}:mqrecieved', self._safe_json_stringify(msg))
+            if not parsed_route.error:
+                service_name = parsed_route.service_name
+                data = await self._compress_for_service(msg, service_name, self._safe_json_stringify(msg))
+                priority = self._queue_priority(msg)
+                due = self._queue_due_time(msg)
+                default = self._QUEUE_PRIORITIES.index(self._QUEUE_DEFAULT_PRIORITY)
+                # messages are laid out for the target's consumers, whichever backend this service consumes with
+                backend, lanes_supported = await self._queue_target(service_name)
+                if (due or priority != default) and not lanes_supported:
+                    self._queue_lanes_unsupported = self._queue_lanes_unsupported + 1
+                    priority = default
+                    due = None
+                ready, delayed = self._queue_lanes(service_name, backend)[priority]
+                if due:
+                    await self._redis.zadd(delayed, due, data)
+                elif backend == 'reliable':
+                    tr = self._redis.multi_exec()
+                    tr.hset(self._queue_keys(service_name)['messages'], msg['mid'], data)
+                    tr.lpush(ready, msg['mid'])
+                    await tr.execute()
+                elif backend == 'stream':
+                    await self._redis.xadd(ready, {'message': data}, max_len=self._queue_max_length)
+                else:
+                    await self._redis.lpush(ready, data)
+                if service_name == self._service_name and self._queue_wakeup and not due:
+                    self._queue_wakeup.set()
 
     async def get_queue_message(self, service_name):
         ''' use self._service_name here to enforce that only a service message '''
         ''' owner can dequeue a message '''
-        res = await self._redis.rpoplpush(f'{self._redis_pre_key}:{self._service_name}:mqrecieved', f'{self._redis_pre_key}:{self._service_name}:mqinprogress')
-        if res:
-            return json.loads(res)
-        return None
+        messages = await self.get_queue_messages(1)
+        return messages[0] if messages else None
+
+    async def get_queue_messages(self, count):
+        '''dequeue up to count messages for this service in a single round trip'''
+        messages = await self._dequeue_messages(count)
+        if self._dedup_completed and messages:
+            messages = await self._drop_completed_queue_messages(messages)
+        return messages
+
+    async def _drop_completed_queue_messages(self, messages):
+        '''acknowledge and skip messages which were already completed, here or by another instance'''
+        completed = [self._dedup_completed.contains(message['mid']) for message in messages]
+        if self._dedup_window:
+            keys = [f'{self._redis_pre_key}:{self._service_name}:mq:completed:{message["mid"]}' for message in messages]
+            completed = [local or exists for local, exists in zip(
+                completed, await asyncio.gather(*[self._redis.exists(key) for key in keys]))]
+        duplicates = [message for message, done in zip(messages, completed) if done]
+        if not duplicates:
+            return messages
+        self._dedup_completed.duplicates = self._dedup_completed.duplicates + len(duplicates)
+        await self.mark_queue_messages(duplicates, True, 'duplicate')
+        return [message for message, done in zip(messages, completed) if not done]
+
+    async def _remember_completed_queue_messages(self, messages):
+        for message in messages:
+            self._dedup_completed.add(message['mid'])
+        if self._dedup_window:
+            await asyncio.gather(*[self._redis.set(f'{self._redis_pre_key}:{self._service_name}:mq:completed:{message["mid"]}',
+                                                   1, expire=self._dedup_window) for message in messages])
+
+    def get_dedup_stats(self):
+        if not self._dedup_received:
+            return None
+        return {
+            'received': self._dedup_received.stats(),
+            'queue': self._dedup_completed.stats()
+        }
+
+    async def _dequeue_messages(self, count):
+        if self._queue_backend == 'stream':
+            return await self._get_stream_messages(count)
+        # due delayed messages are promoted and lanes drained highest priority first, all in one script
+        lists = self._queue_lanes(self._service_name, 'list')
+        now = time.time()
+        if self._queue_backend == 'reliable':
+            keys = self._queue_keys(self._service_name)
+            lanes = [key for (pending, delayed), (mqrecieved, _) in zip(self._queue_lanes(self._service_name), lists)
+                     for key in (pending, mqrecieved, delayed)]
+            res = await self._run_script(_QUEUE_DEQUEUE_SCRIPT,
+                                         [keys['inprogress'], keys['messages']] + lanes,
+                                         [now, count, self._queue_promote_batch_size,
+                                          now + self._queue_visibility_timeout])
+        else:
+            res = await self._run_script(_QUEUE_LIST_DEQUEUE_SCRIPT,
+                                         [f'{self._redis_pre_key}:{self._service_name}:mqinprogress'] +
+                                         [key for lane in lists for key in lane],
+                                         [now, count, self._queue_promote_batch_size])
+        messages = []
+        for item in res:
+            if item:
+                message = self._decode_message(item)
+                # remembered until marked, so shutdown can requeue what was never acknowledged
+                self._queue_unacked[message['mid']] = item
+                messages.append(message)
+        return messages
 
     async def mark_queue_message(self, message, completed, reason):
         ''' use self._service_name here to enforce that only a service message '''
         ''' owner can mark a message as processed '''
-        smsg = self._safe_json_stringify(message)
-        await self._redis.lrem(f'{self._redis_pre_key}:{self._service_name}:mqinprogress', -1, smsg)
-        if 'bdy' in message:
-            message['bdy']['reason'] = reason or 'reason not provided'
-        if not completed:
-            smsg = self._safe_json_stringify(message)
-            self._redis.rpush(f'{self._redis_pre_key}:{self._service_name}:mqincomplete', smsg)
-        return message
+        return (await self.mark_queue_messages([message], completed, reason))[0]
+
+    async def mark_queue_messages(self, messages, completed, reason):
+        '''mark a batch of dequeued messages in a single round trip'''
+        if not messages:
+            return messages
+        if completed and self._dedup_completed:
+            await self._remember_completed_queue_messages(messages)
+        if self._queue_backend == 'reliable':
+            return await self._mark_reliable_queue_messages(messages, completed, reason)
+        if self._queue_backend == 'stream':
+            return await self._mark_stream_messages(messages, completed, reason)
+        tr = self._redis.multi_exec()
+        for message in messages:
+            raw = self._queue_unacked.pop(message['mid'], None) or self._safe_json_stringify(message)
+            tr.lrem(f'{self._redis_pre_key}:{self._service_name}:mqinprogress', -1, raw)
+        for message in messages:
+            if 'bdy' in message:
+                message['bdy']['reason'] = reason or 'reason not provided'
+            if not completed:
+                tr.rpush(f'{self._redis_pre_key}:{self._service_name}:mqincomplete', self._safe_json_stringify(message))
+        await tr.execute()
+        return messages
+
+    async def _mark_reliable_queue_messages(self, messages, completed, reason):
+        '''acknowledge by mid, no need to match the serialized message'''
+        keys = self._queue_keys(self._service_name)
+        ids = [message['mid'] for message in messages]
+        for mid in ids:
+            self._queue_unacked.pop(mid, None)
+        tr = self._redis.multi_exec()
+        tr.zrem(keys['inprogress'], *ids)
+        tr.hdel(keys['messages'], *ids)
+        for message in messages:
+            if 'bdy' in message:
+                message['bdy']['reason'] = reason or 'reason not provided'
+            if not completed:
+                tr.rpush(f'{self._redis_pre_key}:{self._service_name}:mqincomplete', self._safe_json_stringify(message))
+        await tr.execute()
+        return messages
+
+    async def _get_stream_messages(self, count):
+        entries = self._stream_claimed[:count]
+        del self._stream_claimed[:count]
+        if len(entries) < count:
+            if self._queue_block_timeout is None:
+                res = await self._read_stream(self._redis, count - len(entries))
+            else:
+                # a blocking read would hold up every other command sharing the pool's connection
+                with await self._redis as conn:
+                    res = await self._read_stream(conn, count - len(entries))
+            entries.extend((entry_id, fields) for _, entry_id, fields in res)
+        messages = []
+        for entry_id, fields in entries:
+            message = self._decode_message(fields['message'])
+            self._stream_entries[message['mid']] = entry_id
+            messages.append(message)
+        return messages
+
+    async def _read_stream(self, redis, count):
+        return await redis.xread_group(self._service_name, self._instance_id,
+                                       [self._queue_keys(self._service_name)['stream']],
+                                       timeout=self._queue_block_timeout, count=count, latest_ids=['>'])
+
+    async def _mark_stream_messages(self, messages, completed, reason):
+        ids = [self._stream_entries.pop(message['mid']) for message in messages if message['mid'] in self._stream_entries]
+        tr = self._redis.multi_exec()
+        if ids:
+            tr.xack(self._queue_keys(self._service_name)['stream'], self._service_name, *ids)
+        for message in messages:
+            if 'bdy' in message:
+                message['bdy']['reason'] = reason or 'reason not provided'
+            if not completed:
+                tr.rpush(f'{self._redis_pre_key}:{self._service_name}:mqincomplete', self._safe_json_stringify(message))
+        await tr.execute()
+        return messages
+
+    async def _claim_stream_messages(self):
+        '''take over entries other consumers left unacknowledged past the visibility timeout'''
+        res = await self._redis.execute('XAUTOCLAIM', self._queue_keys(self._service_name)['stream'],
+                                        self._service_name, self._instance_id,
+                                        int(self._queue_visibility_timeout * 1000),
+                                        self._stream_claim_cursor, 'COUNT', self._QUEUE_BATCH_SIZE)
+        self._stream_claim_cursor = res[0]
+        claimed = aioredis.commands.streams.parse_messages(res[1])
+        self._stream_claimed.extend(claimed)
+        return len(claimed)
+
+    async def get_queue_stats(self):
+        '''queue depth and in-progress counts for this service'''
+        keys = self._queue_keys(self._service_name)
+        if self._queue_backend == 'stream':
+            lanes = self._queue_lanes(self._service_name, 'list')
+            length, pending, *counts = await asyncio.gather(
+                self._redis.xlen(keys['stream']),
+                self._redis.xpending(keys['stream'], self._service_name),
+                *[self._redis.llen(ready) for ready, _ in lanes],
+                *[self._redis.zcard(key) for _, key in lanes])
+            # messages waiting in mqrecieved are appended to the stream by the queue maintenance task
+            queued, delayed = counts[:len(lanes)], counts[len(lanes):]
+            return {
+                'backend': self._queue_backend,
+                'length': length + sum(queued),
+                'inProgress': pending[0],
+                'consumers': {consumer: int(n) for consumer, n in (pending[3] or [])},
+                'delayed': sum(delayed),
+                'lanesUnsupported': self._queue_lanes_unsupported
+            }
+        lanes = self._queue_lanes(self._service_name)
+        tr = self._redis.multi_exec()
+        if self._queue_backend == 'reliable':
+            in_progress = tr.zcard(keys['inprogress'])
+        else:
+            in_progress = tr.llen(f'{self._redis_pre_key}:{self._service_name}:mqinprogress')
+        ready = [ready for ready, _ in lanes]
+        if self._queue_backend == 'reliable':
+            # list backend producers push to the mqrecieved lanes reliable consumers also drain
+            ready = ready + [ready for ready, _ in self._queue_lanes(self._service_name, 'list')]
+        queued = [tr.llen(key) for key in ready]
+        delayed = [tr.zcard(key) for _, key in lanes]
+        await tr.execute()
+        queued = [await f for f in queued]
+        queued = [sum(queued[i::len(lanes)]) for i in range(len(lanes))]
+        return {
+            'backend': self._queue_backend,
+            'length': sum(queued),
+            'inProgress': await in_progress,
+            'lanes': dict(zip(self._QUEUE_PRIORITIES, queued)),
+            'delayed': sum([await f for f in delayed]),
+            'lanesUnsupported': self._queue_lanes_unsupported
+        }
+
+    async def _reclaim_queue_messages(self):
+        '''return messages whose visibility timeout expired (crashed consumers) to the queue'''
+        keys = self._queue_keys(self._service_name)
+        return await self._run_script(_QUEUE_RECLAIM_SCRIPT,
+                                      [keys['inprogress'], keys['messages']] +
+                                      [ready for ready, _ in self._queue_lanes(self._service_name)],
+                                      [time.time(), self._QUEUE_BATCH_SIZE, self._QUEUE_DEFAULT_PRIORITY] +
+                                      list(self._QUEUE_PRIORITIES))
+
+    async def _promote_stream_messages(self):
+        '''append due delayed messages and messages pushed to the mqrecieved lanes to the stream'''
+        keys = [self._queue_keys(self._service_name)['stream']] + \
+            [key for lane in self._queue_lanes(self._service_name, 'list') for key in lane]
+        promoted = 0
+        while True:
+            n = await self._run_script(_QUEUE_STREAM_PROMOTE_SCRIPT, keys,
+                                       [time.time(), self._queue_promote_batch_size, self._queue_max_length])
+            promoted = promoted + n
+            if n < self._queue_promote_batch_size:
+                return promoted
+
+    async def migrate_queue(self):
+        '''move messages from the list based queue keys into the reliable queue'''
+        keys = self._queue_keys(self._service_name)
+        moved = 0
+        # in progress messages are older than received ones so they're requeued first
+        for source in ('mqinprogress', 'mqrecieved'):
+            while True:
+                n = await self._run_script(_QUEUE_MIGRATE_SCRIPT,
+                                           [f'{self._redis_pre_key}:{self._service_name}:{source}',
+                                            keys['pending'], keys['messages']],
+                                           [self._QUEUE_BATCH_SIZE])
+                moved = moved + n
+                if n < self._QUEUE_BATCH_SIZE:
+                    break
+        return moved
 
     async def _health_check_event(self):
-        tr = self._redis.multi_exec()
+        metrics = await asyncio.get_running_loop().run_in_executor(None, self._collect_process_metrics)
+        self._health = self._build_health(metrics)
+        self._load = {
+            'cpu': self._health['cpuPercent'],
+            'lag': self._health['eventLoopLagSeconds'],
+            'inFlight': self._health['inFlightHandlers']
+        }
+        tr = self._heartbeat_redis.multi_exec()
         f1 = tr.setex(f'{self._redis_pre_key}:{self._service_name}:{self._instance_id}:health',
                       self._KEY_EXPIRATION_TTL,
-                      self._safe_json_stringify(self.get_health()))
+                      self._safe_json_stringify(self._health))
         f2 = tr.expire(f'{self._redis_pre_key}:{self._service_name}:{self._instance_id}:health:log',
                        self._ONE_WEEK_IN_SECONDS)
         await tr.execute()
@@ -509,32 +2615,337 @@ class HydraPy:
             await self._queue_handler()
 
     async def _hydra_events(self):
+        loop = asyncio.get_running_loop()
+        heartbeat = None
         while True:
+            started = loop.time()
             await asyncio.sleep(self._PRESENCE_UPDATE_INTERVAL)
+            self._loop_lag = max(0, loop.time() - started - self._PRESENCE_UPDATE_INTERVAL)
             await self._presence_event()
+            if self._metrics:
+                now = loop.time()
+                if heartbeat is not None:
+                    self._metrics.observe('heartbeat_jitter', abs(now - heartbeat - self._PRESENCE_UPDATE_INTERVAL))
+                heartbeat = now
+            if self._presence_cache:
+                self._presence_cache.tick()
             self._hydra_event_count = self._hydra_event_count + 1
             if self._hydra_event_count % self._HEALTH_UPDATE_INTERVAL == 0:
                 self._hydra_event_count = 0
                 await self._health_check_event()
-            if self._queue_handler:
-                await self._queue_handler()
+                if self._circuit_breaker:
+                    self._circuit_breaker.prune()
+
+    async def _maintain_queue(self):
+        '''return expired messages to the queue and promote due ones, on a task of its own so
+        a failing or slow queue command can't hold up or stop the heartbeats'''
+        while True:
+            await asyncio.sleep(self._PRESENCE_UPDATE_INTERVAL)
+            try:
+                if self._queue_backend == 'reliable':
+                    await self._reclaim_queue_messages()
+                else:
+                    await self._promote_stream_messages()
+                    await self._claim_stream_messages()
+            except Exception as e:
+                asyncio.get_running_loop().call_exception_handler({
+                    'message': 'queue maintenance failed',
+                    'exception': e
+                })
+
+    async def _probe_loop_lag(self):
+        '''sample event loop lag more often than the heartbeat so short stalls show up'''
+        loop = asyncio.get_running_loop()
+        interval = self._lag_probe_interval
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            self._metrics.observe('event_loop_lag', max(0, loop.time() - started - interval))
+
+    async def _queue_events(self):
+        '''call the queue handler on every tick, and keep calling it while it reports work done'''
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._queue_wakeup.wait(), self._PRESENCE_UPDATE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._queue_wakeup.clear()
+            while self._queue_handler and not self._stopping:
+                try:
+                    if not await self._queue_handler():
+                        break
+                except Exception as e:
+                    asyncio.get_running_loop().call_exception_handler({
+                        'message': 'queue handler raised an exception',
+                        'exception': e
+                    })
+                    break
+                await asyncio.sleep(0)
 
     async def init(self, override_redis_connection_string=None):
         self._instance_id = uuid.uuid4().hex
+        self._process = psutil.Process(os.getpid())
+        self._process_started = self._process.create_time()
+        self._host_name = socket.gethostname()
+        self._platform_info = {
+            'architecture': platform.machine(),
+            'platform': platform.system(),
+            'nodeVersion': f'{platform.python_implementation()} {platform.python_version()}'
+        }
+        self._presence_entry = {
+            'serviceName': self._service_name,
+            'serviceDescription': self._service_description,
+            'version': self._service_version,
+            'instanceID': self._instance_id,
+            'processID': self._process.pid,
+            'ip': self._service_ip,
+            'port': self._service_port,
+            'hostName': self._host_name
+        }
+        if 'HYDRA_WORKER_INDEX' in os.environ:
+            self._presence_entry['workerIndex'] = int(os.environ['HYDRA_WORKER_INDEX'])
         if override_redis_connection_string:
             redis_url = override_redis_connection_string
         else:
             redis_url = self._config['hydra']['redis']
-        self._redis = await aioredis.create_redis_pool(redis_url, encoding='utf-8')
-
+        connections = self._config['hydra'].get('connections', {})
+        self._redis = await aioredis.create_redis_pool(redis_url, encoding='utf-8',
+                                                       minsize=connections.get('minSize', 1),
+                                                       maxsize=connections.get('maxSize', 10),
+                                                       pool_cls=MeasuredConnectionsPool)
+        # subscriptions hold a connection of their own, and heartbeats shouldn't wait behind bulk traffic
+        if connections.get('dedicatedSubscriber', True):
+            self._subscriber_redis = await aioredis.create_redis_pool(redis_url, encoding='utf-8',
+                                                                      minsize=1, maxsize=1)
+        else:
+            self._subscriber_redis = self._redis
+        if connections.get('reservedHeartbeat', True):
+            self._heartbeat_redis = await aioredis.create_redis_pool(redis_url, encoding='utf-8',
+                                                                     minsize=1, maxsize=1,
+                                                                     pool_cls=MeasuredConnectionsPool)
+        else:
+            self._heartbeat_redis = self._redis
+        if self._metrics:
+            self._redis.connection.observe = functools.partial(self._metrics.observe, 'pool_wait')
+            if self._heartbeat_redis is not self._redis:
+                self._heartbeat_redis.connection.observe = functools.partial(self._metrics.observe, 'heartbeat_pool_wait')
+
+        publisher_config = self._config['hydra'].get('publisher', {})
+        if publisher_config.get('enabled', True):
+            self._publisher = OutboundPublisher(
+                self._redis,
+                publisher_config.get('window', 0),
+                publisher_config.get('maxBatch', 100))
+            self._publisher.start()
+
+        self._log_shipper.start()
+
+        if self._queue_backend == 'stream':
+            await self._create_queue_group()
         await self._register_service()
-        asyncio.create_task(self._hydra_events())
-
-        # TODO: determine best way to close
-        # self._redis.close()
-        # await self._redis.wait_closed()
+        self._tasks = [asyncio.create_task(self._hydra_events())]
+        if self._queue_backend != 'list':
+            self._tasks.append(asyncio.create_task(self._maintain_queue()))
+        self._queue_wakeup = asyncio.Event()
+        self._queue_task = asyncio.create_task(self._queue_events())
+        if self._presence_cache and self._presence_keyspace_events:
+            self._tasks.append(asyncio.create_task(self._watch_presence()))
+        if self._metrics:
+            self._tasks.append(asyncio.create_task(self._probe_loop_lag()))
 
         return self.get_service_info()
 
+    async def shutdown(self, drain_timeout=10):
+        '''leave the cluster without losing messages, then close the Redis connections'''
+        if self._stopping:
+            return
+        self._stopping = True
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + drain_timeout
+        for task in self._tasks:
+            task.cancel()
+        # stop routers and other services from picking this instance straight away
+        await self._deregister()
+        await self._notify_router()
+
+        # a socket paused by the block policy would never read the reply to unsubscribe
+        self._update_reading()
+        await self._subscriber_redis.unsubscribe(f'{self._mc_message_key}:{self._service_name}',
+                                                 f'{self._mc_message_key}:{self._service_name}:{self._instance_id}')
+        await asyncio.wait(self._readers + [self._queue_task], timeout=max(0, deadline - loop.time()))
+        for task in self._readers + [self._queue_task]:
+            task.cancel()
+        await asyncio.gather(*self._readers, return_exceptions=True)
+        remaining = await self._dispatcher.drain(max(0, deadline - loop.time()))
+        for message in remaining + await self._unread_messages():
+            await self._spill_message(message)
+        await self._requeue_unacked_messages()
+
+        await self._log_shipper.close()
+        if self._publisher:
+            await self._publisher.close()
+        for client in {self._redis, self._subscriber_redis, self._heartbeat_redis}:
+            client.close()
+            await client.wait_closed()
+
+    async def _unread_messages(self):
+        '''messages still buffered by the unsubscribed channels, readers cancelled at the deadline never got to them'''
+        messages = []
+        for channel in self._channels:
+            while channel.is_active:
+                data = await channel.get()
+                if data is None:
+                    break
+                try:
+                    msg = self._decode_message(data)
+                except ValueError:
+                    continue
+                if not ('rmid' in msg and self._pending_requests.resolve(msg)):
+                    messages.append(msg)
+        return messages
+
+    async def _deregister(self):
+        tr = self._heartbeat_redis.multi_exec()
+        tr.delete(f'{self._redis_pre_key}:{self._service_name}:{self._instance_id}:presence',
+                  f'{self._redis_pre_key}:{self._service_name}:{self._instance_id}:health')
+        tr.hdel(f'{self._redis_pre_key}:nodes', self._instance_id)
+        if self._presence_index:
+            tr.zrem(f'{self._redis_pre_key}:{self._service_name}:instances', self._instance_id)
+        await tr.execute()
+
+    async def _requeue_unacked_messages(self):
+        '''return messages this instance dequeued but never marked to the queue'''
+        if self._queue_backend == 'stream':
+            ids = list(self._stream_entries.values()) + [entry_id for entry_id, _ in self._stream_claimed]
+            self._stream_entries.clear()
+            self._stream_claimed.clear()
+            if ids:
+                # make the entries look idle past the visibility timeout, so other consumers claim them next
+                await self._redis.execute('XCLAIM', self._queue_keys(self._service_name)['stream'],
+                                          self._service_name, self._instance_id, 0, *ids,
+                                          'IDLE', int(self._queue_visibility_timeout * 1000), 'JUSTID')
+            return len(ids)
+        unacked = self._queue_unacked
+        self._queue_unacked = {}
+        if not unacked:
+            return 0
+        lanes = self._queue_lanes(self._service_name)
+        tr = self._redis.multi_exec()
+        if self._queue_backend == 'reliable':
+            tr.zrem(self._queue_keys(self._service_name)['inprogress'], *unacked)
+        for mid, raw in unacked.items():
+            # back to the front of the message's own priority lane
+            ready = lanes[self._queue_priority(self._decode_message(raw))][0]
+            if self._queue_backend == 'reliable':
+                tr.rpush(ready, mid)
+            else:
+                tr.lrem(f'{self._redis_pre_key}:{self._service_name}:mqinprogress', -1, raw)
+                tr.rpush(ready, raw)
+        await tr.execute()
+        return len(unacked)
+
     async def run(self):
         await self._redis.wait_closed()
+
+
+def _run_worker(worker, index):
+    '''worker process entry point, SIGTERM cancels the worker coroutine'''
+    os.environ['HYDRA_WORKER_INDEX'] = str(index)
+    # the supervisor coordinates shutdown, so ignore the SIGINT sent to the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    async def main():
+        task = asyncio.ensure_future(worker())
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(main())
+
+
+class HydraSupervisor:
+    '''Runs a service as several HydraPy worker processes, restarting workers which exit'''
+
+    _logger = logging.getLogger('hydrapy.supervisor')
+
+    def __init__(self, worker, workers=None, config_path=None, restart_delay=1, max_restart_delay=30,
+                 shutdown_timeout=30):
+        if workers is None and config_path:
+            with open(config_path, 'r', encoding='utf-8-sig') as json_file:
+                workers = json.load(json_file)['hydra'].get('workers')
+        self._worker = worker
+        self._workers = workers or os.cpu_count() or 1
+        self._restart_delay = restart_delay
+        self._max_restart_delay = max_restart_delay
+        self._shutdown_timeout = shutdown_timeout
+        self._context = multiprocessing.get_context('fork' if hasattr(os, 'fork') else 'spawn')
+        self._processes = {}
+        self._started = {}
+        self._delays = {}
+        self._pending = {}
+        self._stopping = False
+        self.restarts = 0
+
+    def run(self):
+        '''start the workers and supervise them until SIGTERM or SIGINT'''
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for index in range(self._workers):
+            self._start(index)
+        while not self._stopping:
+            sentinels = {process.sentinel: index for index, process in self._processes.items()
+                         if index not in self._pending}
+            for sentinel in multiprocessing.connection.wait(list(sentinels), timeout=0.5):
+                if not self._stopping:
+                    self._exited(sentinels[sentinel])
+            now = time.monotonic()
+            for index, restart_at in list(self._pending.items()):
+                if restart_at <= now and not self._stopping:
+                    del self._pending[index]
+                    self.restarts = self.restarts + 1
+                    self._start(index)
+        self._shutdown()
+
+    def stats(self):
+        return {
+            'workers': {index: process.pid for index, process in self._processes.items() if process.is_alive()},
+            'restarts': self.restarts
+        }
+
+    def _start(self, index):
+        process = self._context.Process(target=_run_worker, args=(self._worker, index),
+                                        name=f'hydrapy-worker-{index}')
+        process.start()
+        self._processes[index] = process
+        self._started[index] = time.monotonic()
+        self._logger.info('started worker %s (pid %s)', index, process.pid)
+
+    def _exited(self, index):
+        process = self._processes[index]
+        process.join()
+        # back off while a worker keeps crashing soon after it starts
+        if time.monotonic() - self._started[index] < self._max_restart_delay:
+            delay = min(self._delays.get(index, self._restart_delay / 2) * 2, self._max_restart_delay)
+        else:
+            delay = self._restart_delay
+        self._delays[index] = delay
+        self._pending[index] = time.monotonic() + delay
+        self._logger.warning('worker %s (pid %s) exited with %s, restarting in %ss',
+                             index, process.pid, process.exitcode, delay)
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def _shutdown(self):
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self._shutdown_timeout
+        for index, process in self._processes.items():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                self._logger.warning('worker %s (pid %s) did not stop in time, killing it', index, process.pid)
+                process.kill()
+                process.join()
@@ -23,5 +23,9 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     python_requires='>=3.7',
-    install_requires=install_requires
+    install_requires=install_requires,
+    extras_require={
+        'orjson': ['orjson'],
+        'msgpack': ['msgpack']
+    }
 )
@@ -0,0 +1,169 @@
+'''
+HydraPy tests
+
+Run against an in-process fakeredis server, or against the Redis given by the
+HYDRA_TEST_REDIS environment variable. Test functions may be coroutines, each one
+runs in its own event loop and the services it created are shut down afterwards.
+'''
+import asyncio
+import hashlib
+import inspect
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import hydrapy.hydra as hydra_module
+from hydrapy import HydraPy
+
+REDIS_URL = os.environ.get('HYDRA_TEST_REDIS')
+_fake_server = None
+
+
+def use_fake_redis():
+    '''route HydraPy's connection pools to the current test's in-process fakeredis server'''
+    import aioredis.abc
+    import fakeredis.aioredis
+    import lupa
+
+    # fakeredis 1.7 checks pool classes against aioredis.AbcPool, which aioredis only exports from aioredis.abc
+    hydra_module.aioredis.AbcPool = aioredis.abc.AbcPool
+
+    async def create_redis_pool(address, pool_cls=None, **kwargs):
+        if pool_cls:
+            # keep HydraPy's pool instrumentation on top of the fake connections
+            kwargs['pool_cls'] = type(pool_cls.__name__, (pool_cls, fakeredis.aioredis.FakeConnectionsPool), {})
+        return await fakeredis.aioredis.create_redis_pool(server=_fake_server, **kwargs)
+
+    hydra_module.aioredis.create_redis_pool = create_redis_pool
+
+    # fakeredis runs scripts on Lua 5.4 without the cjson, redis.sha1hex and unpack Redis provides
+    runtime = lupa.LuaRuntime
+
+    class RedisLuaRuntime(runtime):
+        def __init__(self, *args, **kwargs):
+            # the runtime itself is set up by the extension type's constructor
+            lua_globals = self.globals()
+            lua_globals.unpack = lua_globals.table.unpack
+            lua_globals.cjson = self.table_from({'decode': self._decode, 'encode': self._encode})
+
+        def execute(self, script, *args):
+            self.globals().redis.sha1hex = lambda data: hashlib.sha1(data).hexdigest().encode()
+            return runtime.execute(self, script, *args)
+
+        def _decode(self, data):
+            try:
+                return self._to_lua(json.loads(data))
+            except ValueError:
+                raise lupa.LuaError('cjson: invalid JSON')
+
+        def _encode(self, value):
+            return json.dumps(dict(value.items()) if lupa.lua_type(value) == 'table' else value).encode()
+
+        def _to_lua(self, value):
+            if isinstance(value, dict):
+                return self.table_from({key: self._to_lua(item) for key, item in value.items()})
+            if isinstance(value, list):
+                return self.table_from([self._to_lua(item) for item in value])
+            if isinstance(value, str):
+                return value.encode()
+            return value
+
+    lupa.LuaRuntime = RedisLuaRuntime
+
+
+if not REDIS_URL:
+    use_fake_redis()
+
+
+class Services:
+    '''creates HydraPy instances for a test, all sharing one Redis'''
+
+    def __init__(self):
+        self.redis_url = REDIS_URL or 'redis://fakeredis'
+        self._services = []
+        self._clients = []
+
+    async def create(self, service_name, extra_config=None, message_handler=None, queue_handler=None):
+        config = {
+            'hydra': {
+                'serviceName': service_name,
+                'serviceIP': '127.0.0.1',
+                'servicePort': 0,
+                'serviceType': 'test',
+                'serviceDescription': 'HydraPy test service',
+                'redis': self.redis_url
+            }
+        }
+        config['hydra'].update(extra_config or {})
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as config_file:
+            json.dump(config, config_file)
+        try:
+            hydra = HydraPy(config_path=config_file.name, version='0.0.0',
+                            message_handler=message_handler, queue_handler=queue_handler)
+        finally:
+            os.unlink(config_file.name)
+        await hydra.init()
+        self._services.append(hydra)
+        # announce the instance now rather than on its first heartbeat
+        await hydra._presence_event()
+        return hydra
+
+    async def redis(self):
+        '''a plain client on the same Redis, for looking at keys directly'''
+        client = await hydra_module.aioredis.create_redis_pool(self.redis_url, encoding='utf-8')
+        self._clients.append(client)
+        return client
+
+    async def supports_streams(self):
+        client = await self.redis()
+        try:
+            await client.xlen('hydra:test:streams')
+        except hydra_module.aioredis.ReplyError:
+            return False
+        return True
+
+    async def reset(self):
+        global _fake_server
+        if REDIS_URL:
+            await (await self.redis()).flushdb()
+        else:
+            import fakeredis
+            _fake_server = fakeredis.FakeServer()
+
+    async def close(self):
+        for hydra in reversed(self._services):
+            await hydra.shutdown(drain_timeout=0.1)
+        for client in self._clients:
+            client.close()
+            await client.wait_closed()
+
+
+@pytest.fixture
+def services():
+    return Services()
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    '''run coroutine tests to completion, then shut down the services they created'''
+    if not inspect.iscoroutinefunction(pyfuncitem.obj):
+        return None
+    kwargs = {name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}
+    fixtures = [value for value in kwargs.values() if isinstance(value, Services)]
+
+    async def run():
+        for fixture in fixtures:
+            await fixture.reset()
+        try:
+            await asyncio.wait_for(pyfuncitem.obj(**kwargs), 30)
+        finally:
+            for fixture in fixtures:
+                await fixture.close()
+
+    asyncio.run(run())
+    return True
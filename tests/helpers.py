@@ -0,0 +1,15 @@
+import asyncio
+
+from hydrapy import UMF_Message
+
+
+def message(to, bdy=None):
+    return UMF_Message().create_message({'to': to, 'frm': 'test-sender:/', 'bdy': bdy or {}})
+
+
+async def wait_for(condition, timeout=2):
+    '''poll until condition() is true, failing the test after timeout seconds'''
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, 'condition not met in time'
+        await asyncio.sleep(0.01)
@@ -0,0 +1,65 @@
+from helpers import message, wait_for
+
+LARGE_BODY = {'rows': [{'id': n, 'name': f'row {n}'} for n in range(2000)]}
+
+
+async def test_large_bodies_are_compressed_and_decoded_lazily(services):
+    received = []
+
+    async def handler(msg):
+        received.append(msg)
+
+    config = {'compression': {'enabled': True, 'threshold': 1024}}
+    receiver = await services.create('test-receiver', config, message_handler=handler)
+    sender = await services.create('test-sender', config)
+    await sender.send_message(message(f'{receiver.get_server_instance_id()}@test-receiver:/', LARGE_BODY))
+    await wait_for(lambda: received)
+    assert not received[0].is_body_decoded()
+    assert received[0]['bdy'] == LARGE_BODY
+    assert 'cmp' not in received[0]
+    stats = sender.get_compression_stats()
+    assert stats['compressed'] == 1
+    assert stats['bytesSaved'] > 0
+
+
+async def test_small_bodies_are_not_compressed(services):
+    sender = await services.create('test-sender', {'compression': {'enabled': True, 'threshold': 1024}})
+    await sender.send_message(message(f'{sender.get_server_instance_id()}@test-sender:/', {'n': 1}))
+    assert sender.get_compression_stats()['compressed'] == 0
+
+
+async def test_peers_without_support_get_plain_bodies(services):
+    sender = await services.create('test-sender', {'compression': {'enabled': True, 'threshold': 1024}})
+    assert sender._compressor.select([{'instanceID': 'old-peer'}]) is None
+    assert sender.get_compression_stats()['unsupported'] == 1
+
+
+async def test_queued_messages_are_compressed(services):
+    hydra = await services.create('test-queue', {'compression': {'enabled': True, 'threshold': 1024}})
+    await hydra.queue_message({'to': 'test-queue:/', 'frm': 'test-queue:/', 'bdy': LARGE_BODY})
+    messages = await hydra.get_queue_messages(1)
+    assert messages[0]['bdy'] == LARGE_BODY
+    assert hydra.get_compression_stats()['decompressed'] == 1
+
+
+async def test_msgpack_services_read_json_queue_messages(services):
+    hydra = await services.create('test-queue', {'codec': 'msgpack', 'compression': {'enabled': True, 'threshold': 1024}})
+    await hydra.queue_message({'to': 'test-queue:/', 'frm': 'test-queue:/', 'bdy': {'n': 1}})
+    await hydra.queue_message({'to': 'test-queue:/', 'frm': 'test-queue:/', 'bdy': LARGE_BODY})
+    messages = await hydra.get_queue_messages(2)
+    assert [message['bdy'] for message in messages] == [{'n': 1}, LARGE_BODY]
+    await hydra.mark_queue_messages(messages, True, 'done')
+
+
+async def test_compressed_msgpack_between_instances(services):
+    received = []
+
+    async def handler(msg):
+        received.append(msg)
+
+    config = {'codec': 'msgpack', 'compression': {'enabled': True, 'threshold': 1024}}
+    receiver = await services.create('test-receiver', config, message_handler=handler)
+    sender = await services.create('test-sender', config)
+    await sender.send_message(message(f'{receiver.get_server_instance_id()}@test-receiver:/', LARGE_BODY))
+    await wait_for(lambda: received)
+    assert received[0]['bdy'] == LARGE_BODY
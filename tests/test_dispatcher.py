@@ -0,0 +1,100 @@
+import asyncio
+import json
+
+from helpers import message, wait_for
+from hydrapy.hydra import MessageDispatcher
+
+
+async def test_block_policy_pauses_reading_until_the_queue_is_half_empty():
+    calls = []
+    release = asyncio.Event()
+
+    async def handler(msg):
+        await release.wait()
+
+    dispatcher = MessageDispatcher(handler, 1, 4, MessageDispatcher.BLOCK, pause_reading=calls.append)
+    dispatcher.start()
+    for n in range(5):
+        await dispatcher.submit(n)
+    assert calls == [True]
+    assert dispatcher.stats()['readingPaused']
+    release.set()
+    await wait_for(lambda: dispatcher.stats()['processed'] == 5)
+    assert calls == [True, False]
+    await dispatcher.drain(0)
+
+
+async def test_drop_oldest_policy_never_pauses_reading():
+    calls = []
+
+    async def handler(msg):
+        await asyncio.sleep(1)
+
+    dispatcher = MessageDispatcher(handler, 1, 2, MessageDispatcher.DROP_OLDEST, pause_reading=calls.append)
+    dispatcher.start()
+    for n in range(5):
+        await dispatcher.submit(n)
+    assert calls == []
+    assert dispatcher.stats()['dropped'] > 0
+    await dispatcher.drain(0)
+
+
+async def test_busy_handlers_stop_reading_from_redis(services):
+    release = asyncio.Event()
+    received = []
+
+    async def handler(msg):
+        await release.wait()
+        received.append(msg['bdy']['n'])
+
+    receiver = await services.create('test-receiver', {'dispatcher': {'maxInFlight': 1, 'queueSize': 2}},
+                                     message_handler=handler)
+    sender = await services.create('test-sender')
+    for n in range(10):
+        await sender.send_message(message(f'{receiver.get_server_instance_id()}@test-receiver:/', {'n': n}))
+    await wait_for(lambda: receiver.get_dispatcher_stats()['readingPaused'])
+    transport = receiver._subscriber_redis.connection._pubsub_conn._writer.transport
+    if hasattr(transport, 'is_reading'):
+        assert not transport.is_reading()
+    release.set()
+    await wait_for(lambda: len(received) == 10)
+    assert sorted(received) == list(range(10))
+    assert not receiver.get_dispatcher_stats()['readingPaused']
+
+
+async def test_handlers_get_replies_while_the_dispatcher_is_full(services):
+    replies = []
+
+    async def respond(msg):
+        await responder.send_message_reply(msg, {'bdy': {'echo': msg['bdy']['n']}})
+
+    async def handler(msg):
+        reply = await receiver.request(dict(message('test-responder:/', msg['bdy']), frm='test-receiver:/'), timeout=2)
+        replies.append(reply['bdy']['echo'])
+
+    responder = await services.create('test-responder', message_handler=respond)
+    receiver = await services.create('test-receiver', {'dispatcher': {'maxInFlight': 1, 'queueSize': 1}},
+                                     message_handler=handler)
+    sender = await services.create('test-sender')
+    for n in range(4):
+        await sender.send_message(message(f'{receiver.get_server_instance_id()}@test-receiver:/', {'n': n}))
+    await wait_for(lambda: len(replies) == 4, timeout=5)
+    assert sorted(replies) == [0, 1, 2, 3]
+    assert receiver.get_request_stats()['timeouts'] == 0
+
+
+async def test_shutdown_queues_every_message_it_did_not_handle(services):
+    async def handler(msg):
+        await asyncio.sleep(60)
+
+    receiver = await services.create('test-receiver', {'dispatcher': {'maxInFlight': 1, 'queueSize': 2}},
+                                     message_handler=handler)
+    sender = await services.create('test-sender')
+    for n in range(8):
+        await sender.send_message(message(f'{receiver.get_server_instance_id()}@test-receiver:/', {'n': n}))
+    await wait_for(lambda: receiver.get_dispatcher_stats()['readingPaused'])
+    await asyncio.wait_for(receiver.shutdown(drain_timeout=0.2), 5)
+    assert all(reader.done() for reader in receiver._readers)
+    redis = await services.redis()
+    queued = await redis.lrange('hydra:service:test-receiver:mqrecieved', 0, -1)
+    assert sorted(json.loads(data)['bdy']['n'] for data in queued) == list(range(8))
@@ -0,0 +1,88 @@
+import asyncio
+import json
+import time
+import types
+
+import hydrapy.hydra as hydra_module
+from helpers import message, wait_for
+
+
+def instance(instance_id, age):
+    return {'instanceID': instance_id, 'updatedOnTS': time.time() - age}
+
+
+async def test_heartbeats_are_compared_with_the_freshest_instance(services):
+    hydra = await services.create('test-sender')
+    # a receiving host whose clock is well behind this one
+    instances = [instance('a', 100), instance('b', 101), instance('c', 120)]
+    assert [i['instanceID'] for i in hydra._healthy_instances('test-receiver', instances)] == ['a', 'b']
+    assert hydra.get_circuit_breaker_stats()['staleSkipped'] == 1
+
+
+async def test_healthy_instances_are_cached_per_presence_list(services):
+    hydra = await services.create('test-sender')
+    instances = [instance('a', 0), instance('b', 0)]
+    healthy = hydra._healthy_instances('test-receiver', instances)
+    assert hydra._healthy_instances('test-receiver', instances) is healthy
+    assert hydra._healthy_instances('test-receiver', list(instances)) is not healthy
+
+
+async def test_open_circuits_are_left_out(services):
+    hydra = await services.create('test-sender', {'circuitBreaker': {'failureThreshold': 1}})
+    instances = [instance('a', 0), instance('b', 0)]
+    hydra._circuit_breaker.record_failure('a')
+    assert [i['instanceID'] for i in hydra._healthy_instances('test-receiver', instances)] == ['b']
+    hydra._circuit_breaker.record_failure('b')
+    assert hydra._healthy_instances('test-receiver', instances) == []
+
+
+async def test_messages_reach_instances_with_a_skewed_clock(services):
+    received = []
+
+    async def handler(msg):
+        received.append(msg['bdy'])
+
+    receiver = await services.create('test-receiver', message_handler=handler)
+    redis = await services.redis()
+    entry = json.loads(await redis.hget('hydra:service:nodes', receiver.get_server_instance_id()))
+    entry['updatedOn'] = '2001-01-01T00:00:00.000000Z'
+    await redis.hset('hydra:service:nodes', receiver.get_server_instance_id(), json.dumps(entry))
+    sender = await services.create('test-sender')
+    await sender.send_message(message('test-receiver:/', {'n': 1}))
+    await wait_for(lambda: received)
+
+
+async def test_presence_index_ignores_the_local_clock(services, monkeypatch):
+    config = {'presenceIndex': True}
+    receiver = await services.create('test-receiver', config)
+    sender = await services.create('test-sender', config)
+    # the sender's host clock runs well ahead of everyone else's, Redis included
+    clock = types.ModuleType('time')
+    clock.__dict__.update(time.__dict__)
+    clock.time = lambda: time.time() + 10
+    monkeypatch.setattr(hydra_module, 'time', clock)
+    await sender._presence_event()
+    instances = await sender._fetch_presence('test-receiver')
+    assert [i['instanceID'] for i in instances] == [receiver.get_server_instance_id()]
+    monkeypatch.undo()
+    assert len(await receiver._fetch_presence('test-sender')) == 1
+
+
+async def test_plain_messages_leave_open_circuits_alone(services):
+    received = []
+
+    async def handler(msg):
+        received.append(msg['bdy'])
+
+    receiver = await services.create('test-receiver', message_handler=handler)
+    sender = await services.create('test-sender', {'circuitBreaker': {'failureThreshold': 1, 'cooldown': 0.05}})
+    sender._circuit_breaker.record_failure(receiver.get_server_instance_id())
+    await asyncio.sleep(0.1)
+    for n in range(3):
+        await sender.send_message(message('test-receiver:/', {'n': n}))
+    await wait_for(lambda: len(received) == 3)
+    state = sender.get_circuit_breaker_stats()['instances'][receiver.get_server_instance_id()]
+    assert state['state'] == 'open'
+    await asyncio.sleep(0.5)
+    sender._circuit_breaker.prune()
+    assert sender.get_circuit_breaker_stats()['instances'] == {}
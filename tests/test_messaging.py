@@ -0,0 +1,119 @@
+import asyncio
+import json
+
+import pytest
+
+from helpers import message, wait_for
+
+
+async def test_send_message_to_another_service(services):
+    received = []
+
+    async def handler(msg):
+        received.append(msg['bdy'])
+
+    await services.create('test-receiver', message_handler=handler)
+    sender = await services.create('test-sender')
+    await sender.send_message(message('test-receiver:/', {'n': 1}))
+    await wait_for(lambda: received)
+    assert received == [{'n': 1}]
+
+
+async def test_message_to_own_instance_is_delivered_locally(services):
+    received = []
+
+    async def handler(msg):
+        received.append(msg['bdy'])
+
+    hydra = await services.create('test-receiver', message_handler=handler)
+    await hydra.send_message(message(f'{hydra.get_server_instance_id()}@test-receiver:/', {'n': 1}))
+    await wait_for(lambda: received)
+    assert hydra.get_delivery_stats() == {'local': 1, 'remote': 0}
+
+
+async def test_request_gets_the_reply(services):
+    async def handler(msg):
+        await responder.send_message_reply(msg, {'bdy': {'echo': msg['bdy']['n']}})
+
+    responder = await services.create('test-receiver', message_handler=handler)
+    sender = await services.create('test-sender')
+    reply = await sender.request(message('test-receiver:/', {'n': 7}), timeout=2)
+    assert reply['bdy'] == {'echo': 7}
+
+
+async def test_duplicate_messages_are_dropped(services):
+    received = []
+
+    async def handler(msg):
+        received.append(msg['mid'])
+
+    hydra = await services.create('test-receiver', {'dedup': {'enabled': True}}, message_handler=handler)
+    sender = await services.create('test-sender')
+    msg = message(f'{hydra.get_server_instance_id()}@test-receiver:/')
+    await sender.send_message(msg)
+    await sender.send_message(msg)
+    await wait_for(lambda: hydra.get_dedup_stats()['received']['duplicates'] == 1)
+    assert received == [msg['mid']]
+
+
+async def test_handler_sending_to_its_own_busy_instance_does_not_wait_on_itself(services):
+    received = []
+
+    async def handler(msg):
+        received.append(msg['bdy']['n'])
+        if msg['bdy']['n'] == 0:
+            # the only handler slot is taken by this handler and the queue is full
+            for n in (1, 2):
+                await hydra.send_message(message(f'{hydra.get_server_instance_id()}@test-receiver:/', {'n': n}))
+
+    hydra = await services.create('test-receiver', {'dispatcher': {'maxInFlight': 1, 'queueSize': 1}},
+                                  message_handler=handler)
+    await hydra.send_message(message(f'{hydra.get_server_instance_id()}@test-receiver:/', {'n': 0}))
+    await wait_for(lambda: len(received) == 3)
+    assert sorted(received) == [0, 1, 2]
+    assert hydra.get_delivery_stats() == {'local': 2, 'remote': 1}
+
+
+async def test_request_without_an_instance_fails_straight_away(services):
+    sender = await services.create('test-sender')
+    started = asyncio.get_running_loop().time()
+    with pytest.raises(LookupError):
+        await sender.request(message('test-missing:/'), timeout=5)
+    assert asyncio.get_running_loop().time() - started < 1
+    assert sender.get_request_stats()['pending'] == 0
+
+
+async def test_payloads_which_are_not_messages_are_skipped(services):
+    received = []
+
+    async def handler(msg):
+        received.append(msg['bdy'])
+
+    hydra = await services.create('test-receiver', message_handler=handler)
+    redis = await services.redis()
+    channel = f'hydra:service:mc:test-receiver:{hydra.get_server_instance_id()}'
+    for payload in ('123', 'null', '"text"', '[1]', '{'):
+        await redis.publish(channel, payload)
+    await redis.publish(channel, json.dumps(message(f'{hydra.get_server_instance_id()}@test-receiver:/', {'n': 1})))
+    await wait_for(lambda: received)
+    assert received == [{'n': 1}]
+
+
+async def test_message_counters_are_labelled_by_service(services):
+    received = []
+
+    async def handler(msg):
+        received.append(msg['bdy'])
+
+    config = {'metrics': {'enabled': True}}
+    receivers = [await services.create('test-receiver', config, message_handler=handler) for _ in range(2)]
+    sender = await services.create('test-sender', config)
+    for receiver in receivers:
+        await sender.send_message(message(f'{receiver.get_server_instance_id()}@test-receiver:/'))
+    await sender.send_broadcast_message(message('test-receiver:/'))
+    await wait_for(lambda: len(received) == 4)
+    assert sender.get_metrics()['counters']['messages_out'] == {'test-receiver': 3}
+    assert receivers[0].get_metrics()['counters']['messages_in'] == {'instance': 1, 'service': 1}
+    counters = [line for line in sender.get_prometheus_metrics().splitlines() if line.startswith('hydrapy_messages')]
+    assert counters == [f'hydrapy_messages_out_total{{service="test-sender",instance="{sender.get_server_instance_id()}",'
+                        f'target="test-receiver"}} 3']
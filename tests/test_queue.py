@@ -0,0 +1,214 @@
+import asyncio
+import json
+
+import pytest
+
+from hydrapy import UMF_Message
+
+
+def queued(service_name, n, **headers):
+    return {'to': f'{service_name}:/', 'frm': 'test-producer:/', 'hdr': headers, 'bdy': {'n': n}}
+
+
+def numbers(messages):
+    return [message['bdy']['n'] for message in messages]
+
+
+@pytest.mark.parametrize('backend', ['list', 'reliable'])
+async def test_queue_round_trip(services, backend):
+    hydra = await services.create('test-queue', {'queue': {'backend': backend}})
+    for n in range(3):
+        await hydra.queue_message(queued('test-queue', n))
+    messages = await hydra.get_queue_messages(10)
+    assert numbers(messages) == [0, 1, 2]
+    await hydra.mark_queue_messages(messages, True, 'done')
+    stats = await hydra.get_queue_stats()
+    assert stats['length'] == 0
+    assert stats['inProgress'] == 0
+
+
+@pytest.mark.parametrize('backend', ['list', 'reliable'])
+async def test_incomplete_messages_are_kept(services, backend):
+    hydra = await services.create('test-queue', {'queue': {'backend': backend}})
+    await hydra.queue_message(queued('test-queue', 1))
+    message = await hydra.get_queue_message('test-queue')
+    await hydra.mark_queue_message(message, False, 'failed')
+    redis = await services.redis()
+    assert await redis.llen('hydra:service:test-queue:mqincomplete') == 1
+
+
+@pytest.mark.parametrize('backend', ['list', 'reliable'])
+async def test_higher_priorities_are_dequeued_first(services, backend):
+    hydra = await services.create('test-queue', {'queue': {'backend': backend}})
+    await hydra.queue_message(queued('test-queue', 'low', priority='low'))
+    await hydra.queue_message(queued('test-queue', 'normal'))
+    await hydra.queue_message(queued('test-queue', 'high', priority='high'))
+    await hydra.queue_message(queued('test-queue', 'unknown', priority='urgent'))
+    assert numbers(await hydra.get_queue_messages(10)) == ['high', 'normal', 'unknown', 'low']
+
+
+@pytest.mark.parametrize('backend', ['list', 'reliable'])
+async def test_delayed_messages_wait_until_due(services, backend):
+    hydra = await services.create('test-queue', {'queue': {'backend': backend}})
+    await hydra.queue_message(queued('test-queue', 'delayed', delay=0.3))
+    await hydra.queue_message(queued('test-queue', 'now'))
+    assert numbers(await hydra.get_queue_messages(10)) == ['now']
+    assert (await hydra.get_queue_stats())['delayed'] == 1
+    await asyncio.sleep(0.4)
+    assert numbers(await hydra.get_queue_messages(10)) == ['delayed']
+
+
+@pytest.mark.parametrize('backend', ['list', 'reliable'])
+async def test_unmarked_messages_return_to_their_lane_at_shutdown(services, backend):
+    consumer = await services.create('test-queue', {'queue': {'backend': backend}})
+    await consumer.queue_message(queued('test-queue', 'high', priority='high'))
+    await consumer.queue_message(queued('test-queue', 'normal'))
+    assert numbers(await consumer.get_queue_messages(1)) == ['high']
+    await consumer.shutdown(drain_timeout=0.1)
+    other = await services.create('test-queue', {'queue': {'backend': backend}})
+    assert numbers(await other.get_queue_messages(10)) == ['high', 'normal']
+
+
+async def test_reliable_queue_reads_list_producers(services):
+    producer = await services.create('test-producer')
+    consumer = await services.create('test-queue', {'queue': {'backend': 'reliable'}})
+    await producer.queue_message(queued('test-queue', 1))
+    assert numbers(await consumer.get_queue_messages(10)) == [1]
+
+
+async def test_stream_queue_round_trip(services):
+    if not await services.supports_streams():
+        pytest.skip('Redis without stream support')
+    hydra = await services.create('test-queue', {'queue': {'backend': 'stream'}})
+    for n in range(3):
+        await hydra.queue_message(queued('test-queue', n))
+    messages = await hydra.get_queue_messages(10)
+    assert numbers(messages) == [0, 1, 2]
+    await hydra.mark_queue_messages(messages, True, 'done')
+    assert (await hydra.get_queue_stats())['inProgress'] == 0
+
+
+async def test_reliable_queue_reclaims_expired_messages(services):
+    hydra = await services.create('test-queue', {'queue': {'backend': 'reliable', 'visibilityTimeout': 0.1}})
+    await hydra.queue_message(queued('test-queue', 1))
+    assert numbers(await hydra.get_queue_messages(1)) == [1]
+    hydra._queue_unacked.clear()
+    await asyncio.sleep(1.3)
+    assert numbers(await hydra.get_queue_messages(1)) == [1]
+
+
+async def test_failing_queue_maintenance_keeps_heartbeats_going(services):
+    hydra = await services.create('test-queue', {'queue': {'backend': 'reliable'}})
+    failures = []
+
+    async def fail():
+        failures.append(1)
+        raise ConnectionError('lost the connection')
+
+    hydra._reclaim_queue_messages = fail
+    reported = []
+    asyncio.get_running_loop().set_exception_handler(lambda loop, context: reported.append(context['message']))
+    redis = await services.redis()
+    key = f'hydra:service:test-queue:{hydra.get_server_instance_id()}:presence'
+    await redis.delete(key)
+    await asyncio.sleep(2.2)
+    assert len(failures) >= 2
+    assert reported[:2] == ['queue maintenance failed'] * 2
+    assert await redis.exists(key)
+
+
+@pytest.mark.parametrize('producer_backend', ['list', 'reliable'])
+async def test_reliable_consumers_read_every_lane_of_any_producer(services, producer_backend):
+    consumer = await services.create('test-queue', {'queue': {'backend': 'reliable'}})
+    producer = await services.create('test-producer', {'queue': {'backend': producer_backend}})
+    await producer.queue_message(queued('test-queue', 'low', priority='low'))
+    await producer.queue_message(queued('test-queue', 'high', priority='high'))
+    await producer.queue_message(queued('test-queue', 'delayed', priority='high', delay=0.2))
+    assert numbers(await consumer.get_queue_messages(10)) == ['high', 'low']
+    await asyncio.sleep(0.3)
+    assert numbers(await consumer.get_queue_messages(10)) == ['delayed']
+
+
+async def test_lanes_are_only_used_when_every_consumer_reads_them(services):
+    consumer = await services.create('test-queue')
+    producer = await services.create('test-producer')
+    redis = await services.redis()
+    # an instance built with another Hydra implementation, which only reads mqrecieved
+    await redis.hset('hydra:service:nodes', 'other-instance', json.dumps({
+        'serviceName': 'test-queue',
+        'instanceID': 'other-instance',
+        'updatedOn': UMF_Message.get_time_stamp()
+    }))
+    await redis.set('hydra:service:test-queue:other-instance:presence', 'other-instance')
+    producer.invalidate_presence()
+    await producer.queue_message(queued('test-queue', 'high', priority='high'))
+    await producer.queue_message(queued('test-queue', 'delayed', delay=60))
+    assert await redis.llen('hydra:service:test-queue:mqrecieved') == 2
+    assert numbers(await consumer.get_queue_messages(10)) == ['high', 'delayed']
+    assert (await producer.get_queue_stats())['lanesUnsupported'] == 2
+
+
+async def test_stream_consumers_read_what_other_producers_queue(services):
+    if not await services.supports_streams():
+        pytest.skip('Redis without stream support')
+    consumer = await services.create('test-queue', {'queue': {'backend': 'stream'}})
+    producer = await services.create('test-producer')
+    await producer.queue_message(queued('test-queue', 'direct'))
+    # as queued by another Hydra implementation, or while no consumer was running
+    redis = await services.redis()
+    await redis.lpush('hydra:service:test-queue:mqrecieved', json.dumps(UMF_Message().create_message(queued('test-queue', 'other'))))
+    await redis.lpush('hydra:service:test-queue:mqrecieved:high',
+                      json.dumps(UMF_Message().create_message(queued('test-queue', 'high', priority='high'))))
+    assert (await consumer.get_queue_stats())['length'] == 3
+    assert await consumer._promote_stream_messages() == 2
+    assert numbers(await consumer.get_queue_messages(10)) == ['direct', 'high', 'other']
+
+
+@pytest.mark.parametrize('producer_backend', ['reliable', 'stream'])
+async def test_producers_queue_for_the_target_backend(services, producer_backend):
+    if producer_backend == 'stream' and not await services.supports_streams():
+        pytest.skip('Redis without stream support')
+    consumer = await services.create('test-queue')
+    producer = await services.create('test-producer', {'queue': {'backend': producer_backend}})
+    await producer.queue_message(queued('test-queue', 1))
+    assert numbers([await consumer.get_queue_message('test-queue')]) == [1]
+
+
+@pytest.mark.parametrize('producer_backend', ['reliable', 'stream'])
+async def test_producers_queue_to_mqrecieved_without_consumers(services, producer_backend):
+    if producer_backend == 'stream' and not await services.supports_streams():
+        pytest.skip('Redis without stream support')
+    producer = await services.create('test-producer', {'queue': {'backend': producer_backend}})
+    await producer.queue_message(queued('test-queue', 1))
+    redis = await services.redis()
+    assert await redis.llen('hydra:service:test-queue:mqrecieved') == 1
+
+
+async def test_blocking_stream_reads_use_their_own_connection(services):
+    if not await services.supports_streams():
+        pytest.skip('Redis without stream support')
+    consumer = await services.create('test-queue', {'queue': {'backend': 'stream', 'blockTimeout': 1000}})
+    clients = []
+    read_stream = consumer._read_stream
+
+    async def record(redis, count):
+        clients.append(redis)
+        return await read_stream(redis, count)
+
+    consumer._read_stream = record
+    assert await consumer.get_queue_messages(1) == []
+    # XREADGROUP BLOCK on the shared connection would hold up every command queued behind it
+    assert clients and clients[0] is not consumer.get_redis_client()
+
+
+@pytest.mark.parametrize('backend', ['list', 'reliable'])
+async def test_priorities_and_delays_are_kept_while_no_consumer_runs(services, backend):
+    producer = await services.create('test-producer')
+    await producer.queue_message(queued('test-queue', 'normal'))
+    await producer.queue_message(queued('test-queue', 'high', priority='high'))
+    await producer.queue_message(queued('test-queue', 'delayed', delay=0.3))
+    assert (await producer.get_queue_stats())['lanesUnsupported'] == 0
+    consumer = await services.create('test-queue', {'queue': {'backend': backend}})
+    assert numbers(await consumer.get_queue_messages(10)) == ['high', 'normal']
+    await asyncio.sleep(0.4)
+    assert numbers(await consumer.get_queue_messages(10)) == ['delayed']